@@ -14,30 +14,321 @@ import datetime
 import sqlite3
 import csv
 import codecs
+import gzip
+import hashlib
+import http.client
+import http.server
+import bisect
+import email.utils
+import urllib.parse
 import plugins.eddblink_plug
 import sys
+import os
+import pickle
+import subprocess
+import struct
+import queue
+import multiprocessing
+import concurrent.futures
+import logging
+import logging.handlers
+import atexit
+
+try:
+    # Only used for reporting memory use, not available on Windows.
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    # Used to make zstd compressed copies of the listings exports, if installed.
+    import zstandard
+except ImportError:
+    zstandard = None
 
 from urllib import request
 from calendar import timegm
 from pathlib import Path
 from collections import defaultdict, namedtuple, deque, OrderedDict
+from contextlib import contextmanager
+from types import MappingProxyType
+from array import array
 from distutils.version import LooseVersion
 
+# Everything the listener has to say goes through this logger, or one of its
+# categories, such as "eddblink.market" for the line about each market update,
+# so that each category can be sampled and rate limited on its own.
+log = logging.getLogger("eddblink")
+market_log = log.getChild("market")
+reject_log = log.getChild("reject")
+
+class LogLimiter(logging.Filter):
+    """
+    Samples and rate limits the log records below WARNING by category, (the
+    last part of the logger's name,) before they're queued.
+    sampleEvery is a dict of category => N, keeping only every Nth record
+    of that category, and maxPerMinute is the most records of any one
+    category that are kept in a minute, 0 meaning no limit. The number of
+    records held back by the limit is added to the first record of that
+    category that gets through in the next minute.
+    """
+    window = 60
+
+
+    def __init__(self, sampleEvery=None, maxPerMinute=0):
+        super().__init__()
+        self.sampleEvery = sampleEvery or {}
+        self.maxPerMinute = maxPerMinute
+        self.lock = threading.Lock()
+        self.seen = defaultdict(int)
+        # category => [start of the minute, records kept, records held back]
+        self.windows = {}
+
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        category = record.name.rpartition('.')[2]
+        every = self.sampleEvery.get(category, 1)
+        held = 0
+        with self.lock:
+            if every > 1:
+                self.seen[category] += 1
+                if self.seen[category] % every != 1:
+                    return False
+            if self.maxPerMinute:
+                now = time.time()
+                window = self.windows.get(category)
+                if not window or now >= window[0] + self.window:
+                    held = window[2] if window else 0
+                    window = self.windows[category] = [now, 0, 0]
+                if window[1] >= self.maxPerMinute:
+                    window[2] += 1
+                    return False
+                window[1] += 1
+        if held:
+            record.msg = str(record.msg) + " (" + str(held) + " more '" + category + "' messages were held back in the last minute.)"
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts log records on the log queue for a LogWriter to write, so the
+    threads doing the logging never wait on the console or the log file.
+    When the queue is full, the record is dropped and counted rather than
+    waiting for room.
+    """
+    def __init__(self, logQueue, local=True):
+        super().__init__(logQueue)
+        self.local = local
+        self.dropped = 0
+
+
+    def prepare(self, record):
+        # Records going to another process have to be formatted first so
+        # they can be pickled, but ones for this process are left for the
+        # LogWriter to format.
+        return record if self.local else super().prepare(record)
+
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class ConsoleFormatter(logging.Formatter):
+    """
+    Shows messages on the console the way they always have been, with
+    warnings and errors marked as such.
+    """
+    def format(self, record):
+        message = super().format(record)
+        if record.levelno >= logging.WARNING:
+            message = record.levelname + ": " + message
+        return message
+
+class BufferedLogFile(logging.handlers.RotatingFileHandler):
+    """
+    A rotating log file that's flushed at most once every flushInterval
+    seconds, and when the LogWriter runs out of records to write, rather
+    than after every record. The size of the file is kept track of here,
+    since asking the file for its position would flush it.
+    """
+    flushInterval = 1
+
+
+    def __init__(self, path, maxBytes=0, backupCount=0):
+        self.size = 0
+        self.flushTime = time.time()
+        super().__init__(str(path), 'a', maxBytes, backupCount, "utf-8")
+
+
+    def _open(self):
+        stream = super()._open()
+        self.size = os.path.getsize(self.baseFilename)
+        return stream
+
+
+    def shouldRollover(self, record):
+        if self.maxBytes <= 0:
+            return False
+        self.size += len(self.format(record)) + len(self.terminator)
+        return self.size >= self.maxBytes
+
+
+    def flush(self, force=False):
+        if force or time.time() >= self.flushTime + self.flushInterval:
+            self.flushTime = time.time()
+            super().flush()
+
+class LogWriter(logging.handlers.QueueListener):
+    """
+    The thread that takes the records off the log queue and writes them to
+    the console and the log file. Whenever it runs out of records, it
+    flushes the log file. If source is given, the number of records it had
+    to drop because the queue was full is reported, at most once every
+    reportInterval seconds.
+    """
+    reportInterval = 60
+
+
+    def __init__(self, logQueue, source, *handlers):
+        super().__init__(logQueue, *handlers, respect_handler_level=True)
+        self.source = source
+        self.reported = 0
+        self.reportTime = 0
+
+
+    def dequeue(self, block):
+        while True:
+            try:
+                record = self.queue.get(block, BufferedLogFile.flushInterval if block else None)
+                break
+            except queue.Empty:
+                if not block:
+                    raise
+                for handler in self.handlers:
+                    if isinstance(handler, BufferedLogFile):
+                        handler.flush(True)
+        if self.source and self.source.dropped != self.reported and time.time() >= self.reportTime + self.reportInterval:
+            dropped = self.source.dropped
+            self.handle(logging.makeLogRecord({'name': log.name, 'levelno': logging.WARNING, 'levelname': "WARNING",
+                'msg': "Log queue was full, " + str(dropped - self.reported) + " log messages were dropped."}))
+            self.reported = dropped
+            self.reportTime = time.time()
+        return record
+
+
+    def enqueue_sentinel(self):
+        # Wait for room, rather than losing the records still queued.
+        self.queue.put(self._sentinel)
+
+
+    def add_handler(self, handler):
+        self.handlers += (handler,)
+
+def setup_log_handler(logQueue, local=True):
+    """
+    Sends the records of the "eddblink" logger to logQueue, sampled and
+    rate limited as the config says. Returns the LogQueueHandler.
+    """
+    handler = LogQueueHandler(logQueue, local)
+    handler.addFilter(LogLimiter(config['log_sample_every'], config['log_max_per_minute']))
+    log.addHandler(handler)
+    log.setLevel(logging.DEBUG if config['debug'] else logging.INFO)
+    log.propagate = False
+    return handler
+
+def stop_logging(writers):
+    """
+    Writes whatever is left in the log queues and closes the console and
+    log file. Run at exit, once every other thread has finished.
+    """
+    for writer in writers:
+        writer.stop()
+    for handler in writers[0].handlers:
+        handler.close()
+
 # Copyright (C) Oliver 'kfsone' Smith <oliver@kfs.org> 2015
 #
 # Conditional permission to copy, modify, refactor or use this
 # code is granted so long as attribution to the original author
 # is included.
-class MarketPrice(namedtuple('MarketPrice', [
-        'system',
-        'station',
-        'commodities',
-        'timestamp',
-        'uploader',
-        'software',
-        'version',
-        ])):
-    pass
+class MarketPrice(object):
+    """
+    A market message, cut down to what's needed to write it to the database.
+    The commodities are kept as parallel columns rather than the message's
+    list of dicts, which takes up several times as much memory, so that a
+    large backlog of messages can be held. Blank entries are left out, and
+    commodity names are lower case and interned, so each name is only
+    stored once however many messages have it.
+
+    Attributes:
+        system, station     Names, in upper case,
+        timestamp           When the market was seen,
+        software, version   The software that uploaded it,
+        names               The commodities' names,
+        sellPrices, demandUnits, demandLevels,
+        buyPrices, stockUnits, stockLevels,
+        meanPrices          arrays of each commodity's values, with blank
+                            brackets stored as -1.
+    """
+
+    __slots__ = ('system', 'station', 'timestamp', 'software', 'version', 'names',
+                 'sellPrices', 'demandUnits', 'demandLevels',
+                 'buyPrices', 'stockUnits', 'stockLevels', 'meanPrices')
+
+    def __init__(self, system, station, timestamp, software, version, names,
+                 sellPrices, demandUnits, demandLevels,
+                 buyPrices, stockUnits, stockLevels, meanPrices):
+        self.system = system
+        self.station = station
+        self.timestamp = timestamp
+        self.software = software
+        self.version = version
+        self.names = tuple(names)
+        self.sellPrices = array('i', sellPrices)
+        self.demandUnits = array('q', demandUnits)
+        self.demandLevels = array('b', demandLevels)
+        self.buyPrices = array('i', buyPrices)
+        self.stockUnits = array('q', stockUnits)
+        self.stockLevels = array('b', stockLevels)
+        self.meanPrices = array('i', meanPrices)
+
+
+    @classmethod
+    def from_commodities(cls, system, station, commodities, timestamp, software, version):
+        """
+        Makes a MarketPrice from the list of commodities in an EDDN message.
+        """
+        rows = [(
+            sys.intern(commodity['name'].lower()),
+            commodity['sellPrice'], commodity['demand'],
+            commodity['demandBracket'] if commodity['demandBracket'] != '' else -1,
+            commodity['buyPrice'], commodity['stock'],
+            commodity['stockBracket'] if commodity['stockBracket'] != '' else -1,
+            commodity['meanPrice'],
+        ) for commodity in commodities
+          # Skip blank entries
+          if not (commodity['sellPrice'] == 0 and commodity['buyPrice'] == 0)]
+        return cls(system, station, timestamp, software, version, *(list(zip(*rows)) or [()] * 8))
+
+
+    def fields(self):
+        """
+        Returns the attributes as a list, with the arrays as lists.
+        """
+        return [getattr(self, name) if name in ('system', 'station', 'timestamp', 'software', 'version')
+                else list(getattr(self, name)) for name in self.__slots__]
+
+
+    def rows(self):
+        """
+        Returns each commodity's (name, sellPrice, demandUnits, demandLevel,
+        buyPrice, stockUnits, stockLevel, meanPrice).
+        """
+        return zip(self.names, self.sellPrices, self.demandUnits, self.demandLevels,
+                   self.buyPrices, self.stockUnits, self.stockLevels, self.meanPrices)
 
 class Listener(object):
     """
@@ -60,10 +351,31 @@ class Listener(object):
 
         subscriber          ZMQ socket we're using
         lastRecv            time of the last receive (or 0)
+
+        received            Number of messages received,
+        decoded             Number of valid market messages decoded,
+        rejected            Number of messages rejected, by reason,
+        pending             Number of messages waiting for a decode worker,
+        dropped             Number of messages dropped because the decode
+                            workers had maxPending messages waiting already,
+                            or a decode worker died,
+        brokenPool          The decode pool a worker died in, which has to
+                            be replaced,
+        saturated           Number of times burstLimit was reached, meaning
+                            messages were arriving faster than they were read,
+                            and the socket's receive high-water mark (RCVHWM)
+                            may have been reached, losing messages.
     """
 
     uri = 'tcp://eddn.edcd.io:9500'
     supportedSchema = 'https://eddn.edcd.io/schemas/commodity/3'
+    supportedSchemaBytes = ('"' + supportedSchema + '"').encode()
+    maxPending = 10000
+    reportInterval = 60.     # seconds
+    # In streaming mode, messages are held for up to maxStreamWindow, in
+    # proportion to how close the message rate is to streamFullRate.
+    maxStreamWindow = 1.     # seconds
+    streamFullRate = 200.    # messages per second
 
     def __init__(
         self,
@@ -84,6 +396,16 @@ class Listener(object):
         self.reconnectTimeout = reconnectTimeout
         self.burstLimit = burstLimit
 
+        self.lock = threading.Lock()
+        self.received = 0
+        self.decoded = 0
+        self.rejected = defaultdict(int)
+        self.pending = 0
+        self.dropped = 0
+        self.brokenPool = None
+        self.saturated = 0
+        self.lastReport = (time.time(), 0, 0)
+
         self.connect()
 
 
@@ -99,7 +421,6 @@ class Listener(object):
         newsub.setsockopt(zmq.SUBSCRIBE, b"")
         newsub.connect(self.uri)
         self.lastRecv = time.time()
-        self.lastJsData = None
 
 
     def disconnect(self):
@@ -139,8 +460,6 @@ class Listener(object):
         built-in auto-reconnection if there is nothing from the
         firehose for a period of time.
 
-        As json data is decoded, it is stored in self.lastJsData.
-
         Validated market list messages are added to the queue.
         """
         while go:
@@ -148,10 +467,6 @@ class Listener(object):
             hardCutoff = now + self.maxBatchTime
             softCutoff = now + self.minBatchTime
 
-            # hoists
-            supportedSchema = self.supportedSchema
-            sub = self.subscriber
-
             # Prices are stored as a dictionary of
             # (sys,stn,item) => [MarketPrice]
             # The list thing is a trick to save us having to do
@@ -163,320 +478,1490 @@ class Listener(object):
                 # possibly multiple messages. At this point we can afford to
                 # suck down whatever is waiting in "nonblocking" mode until
                 # we reach the burst limit or we get EAGAIN.
-                bursts = 0
-                for _ in range(self.burstLimit):
-                    self.lastJsData = None
-                    try:
-                        zdata = sub.recv(flags=zmq.NOBLOCK, copy=False)
-                    except zmq.error.Again:
-                        continue
-                    except zmq.error.ZMQError:
-                        pass
+                bursts = self.read_burst(batch)
 
-                    self.lastRecv = time.time()
-                    bursts += 1
+                # For the edge-case where we wait 4.999 seconds and then
+                # get a burst of data: stick around a little longer.
+                if bursts >= self.burstLimit:
+                    softCutoff = min(softCutoff, time.time() + 0.5)
 
-                    try:
-                        jsdata = zlib.decompress(zdata)
-                    except Exception:
-                        continue
 
-                    bdata = jsdata.decode()
+                for entry in batch.values():
+                    queue.put(entry[0])
+            self.report()
+        log.info("Shutting down listener.")
+        self.disconnect()
 
-                    try:
-                        data = json.loads(bdata)
-                    except ValueError:
-                        continue
 
-                    self.lastJsData = jsdata
+    def read_burst(self, batch):
+        """
+        Reads whatever messages are waiting, up to burstLimit of them,
+        stopping as soon as there are none left. The valid market messages
+        are added to batch, a dictionary of (system, station) => [MarketPrice],
+        keeping only the newest for each station.
+        Returns the number of messages read.
+        """
+        sub = self.subscriber
+        bursts = 0
+        receiving = 0
+        for _ in range(self.burstLimit):
+            start = time.time()
+            try:
+                zdata = sub.recv(flags=zmq.NOBLOCK, copy=False)
+            except zmq.error.Again:
+                # Nothing more waiting.
+                break
+            except zmq.error.ZMQError as e:
+                log.error("Unable to receive from the EDDN: " + str(e))
+                break
+
+            self.lastRecv = time.time()
+            receiving += self.lastRecv - start
+            bursts += 1
+            self.received += 1
 
+            entry, reason, detail = decode_message(zdata)
+            if not entry:
+                self.reject(reason, detail)
+                continue
+            self.decoded += 1
+
+            # We'll get either an empty list or a list containing
+            # a MarketPrice. This saves us having to do the expensive
+            # index operation twice.
+            oldEntryList = batch[(entry.system, entry.station)]
+            if oldEntryList:
+                if oldEntryList[0].timestamp > entry.timestamp:
+                    continue
+            else:
+                # Add a blank entry to make the list size > 0
+                oldEntryList.append(None)
+
+            # Here we're replacing the contents of the list.
+            # This simple array lookup is several hundred times less
+            # expensive than looking up a potentially large dictionary
+            # by STATION/SYSTEM:ITEM...
+            oldEntryList[0] = entry
+
+        if bursts >= self.burstLimit:
+            self.saturated += 1
+        if bursts:
+            metrics.observe('receive', receiving)
+            metrics.inc('messages_received_total', bursts)
+        return bursts
+
+
+    def get_stream(self, queue):
+        """
+        Like get_batch(), but rather than waiting for messages over a fixed
+        window, adds them to the queue as soon as the rate they're arriving
+        at allows: when it's quiet, each message is added as soon as it's
+        received, and as the rate goes up, the messages are held for longer,
+        up to maxStreamWindow seconds, so more updates of the same station
+        can be deduped.
+        """
+        batch = defaultdict(list)
+        deadline = None
+        # Messages per second, averaged over roughly the last second.
+        rate = 0.
+        lastBurst = time.time()
+        while go:
+            now = time.time()
+            # Check for shutdown and report at least once a second.
+            cutoff = deadline if deadline else now + 1
+            if cutoff > now and self.wait_for_data(cutoff, cutoff):
+                bursts = self.read_burst(batch)
+                now = time.time()
+                elapsed = max(now - lastBurst, 0.001)
+                weight = min(elapsed, 1.)
+                rate = rate * (1 - weight) + bursts / elapsed * weight
+                lastBurst = now
+
+            if batch:
+                if deadline is None:
+                    deadline = now + self.maxStreamWindow * min(rate / self.streamFullRate, 1.)
+                if now >= deadline:
+                    for entry in batch.values():
+                        queue.put(entry[0])
+                    batch = defaultdict(list)
+                    deadline = None
+            self.report()
+        log.info("Shutting down listener.")
+        self.disconnect()
+
+
+    def get_frames(self, queue, new_pool):
+        """
+        Receives messages from the firehose as fast as they arrive, and hands
+        them, still compressed, to a pool of decode worker processes, which
+        add the valid market messages to the queue. If the workers fall too
+        far behind, new messages are dropped rather than letting them pile up.
+        new_pool is called to start the pool, and again to replace it if a
+        worker dies, in which case the messages it had are dropped.
+        """
+        pool = new_pool()
+        try:
+            while go:
+                now = time.time()
+                # Check for shutdown and report at least once a second.
+                if not self.wait_for_data(now + 1, now + 1):
+                    self.report()
+                    continue
+
+                start = time.time()
+                frames = []
+                for _ in range(self.burstLimit):
                     try:
-                        schema = data["$schemaRef"]
-                    except KeyError:
-                        continue
-                    if schema != supportedSchema:
-                        continue
-                    try:
-                        header = data["header"]
-                        message = data["message"]
-                        system = message["systemName"].upper()
-                        station = message["stationName"].upper()
-                        commodities = message["commodities"]
-                        timestamp = message["timestamp"]
-                        uploader = header["uploaderID"]
-                        software = header["softwareName"]
-                        swVersion = header["softwareVersion"]
-                    except (KeyError, ValueError):
-                        continue
-                    whitelist_match = list(filter(lambda x: x.get('software').lower() == software.lower(), config['whitelist']))
-                    # Upload software not on whitelist is ignored.
-                    if len(whitelist_match) == 0:
-                        if config['debug']:
-                            with debugPath.open('a', encoding = "utf-8") as fh:
-                                fh.write(system + "/" + station + " rejected with:" + software + swVersion +"\n")
+                        frames.append(self.subscriber.recv(flags=zmq.NOBLOCK))
+                    except zmq.error.ZMQError:
+                        # Usually zmq.error.Again, meaning there's nothing more waiting.
+                        break
+                if not frames:
+                    continue
+                self.lastRecv = time.time()
+                metrics.observe('receive', self.lastRecv - start)
+                metrics.inc('messages_received_total', len(frames))
+                if len(frames) >= self.burstLimit:
+                    self.saturated += 1
+
+                with self.lock:
+                    self.received += len(frames)
+                    if self.pending + len(frames) > self.maxPending:
+                        self.dropped += len(frames)
+                        metrics.inc('messages_dropped_total', len(frames), reason = "decoders behind")
                         continue
-                    # Upload software with version less than the defined minimum is ignored. 
-                    if whitelist_match[0].get("minversion"):
-                        if LooseVersion(swVersion) < LooseVersion(whitelist_match[0].get("minversion")):
-                            if config['debug']:
-                                with debugPath.open('a', encoding = "utf-8") as fh:
-                                    fh.write(system + "/" + station + " rejected with:" + software + swVersion +"\n")
-                            continue
-                    # We've received real data.
-
-                    # Normalize timestamps
-                    timestamp = timestamp.replace("T"," ").replace("+00:00","")
-
-                    # We'll get either an empty list or a list containing
-                    # a MarketPrice. This saves us having to do the expensive
-                    # index operation twice.
-                    oldEntryList = batch[(system, station)]
-                    if oldEntryList:
-                        if oldEntryList[0].timestamp > timestamp:
-                            continue
-                    else:
-                        # Add a blank entry to make the list size > 0
-                        oldEntryList.append(None)
-
-                    # Here we're replacing the contents of the list.
-                    # This simple array lookup is several hundred times less
-                    # expensive than looking up a potentially large dictionary
-                    # by STATION/SYSTEM:ITEM...
-                    oldEntryList[0] = MarketPrice(
-                        system, station, commodities,
-                        timestamp,
-                        uploader, software, swVersion,
-                    )
+                    self.pending += len(frames)
+                if self.brokenPool is pool:
+                    pool.shutdown(wait = False)
+                    pool = new_pool()
+                    log.info("Restarted the decode workers.")
+                try:
+                    future = pool.submit(decode_messages, frames)
+                except concurrent.futures.process.BrokenProcessPool as e:
+                    self.decode_failed(len(frames), e, pool)
+                    continue
+                future.add_done_callback(lambda future, count=len(frames), pool=pool:
+                                         self.decoded_frames(future, count, queue, pool))
+                self.report()
+        finally:
+            pool.shutdown()
+        log.info("Shutting down listener.")
+        self.disconnect()
 
-                # For the edge-case where we wait 4.999 seconds and then
-                # get a burst of data: stick around a little longer.
-                if bursts >= self.burstLimit:
-                    softCutoff = min(softCutoff, time.time() + 0.5)
 
+    def decode_failed(self, count, error, pool):
+        """
+        Drops count messages a worker of the decode pool died with, and marks
+        the pool as needing to be replaced.
+        """
+        with self.lock:
+            self.pending -= count
+            self.dropped += count
+            broken = self.brokenPool is pool
+            self.brokenPool = pool
+        metrics.inc('messages_dropped_total', count, reason = "decoder failed")
+        if not broken:
+            log.error("A decode worker died, restarting the decode workers: " + str(error))
 
-                for entry in batch.values():
-                    queue.append(entry[0])
-        print("Shutting down listener.")
-        self.disconnect()
-        
-# End of 'kfsone' code.
 
-def db_execute(db, sql_cmd, args = None):
-    cur = db.cursor()
-    success = False
-    result = None
-    while go and not success:
+    def decoded_frames(self, future, count, queue, pool):
+        """
+        Adds the messages decoded by a decode worker to the queue.
+        """
         try:
-            if args:
-                result = cur.execute(sql_cmd, args)
-            else:
-                result = cur.execute(sql_cmd)
-            success = True
-        except sqlite3.OperationalError as e:
-                if "locked" not in str(e):
-                    success = True
-                    raise sqlite3.OperationalError(e)
-                else:
-                    print("Database is locked, waiting for access.", end = "\n")
-                    time.sleep(1)
-    return result
-    
+            entries, rejected, taken = future.result()
+            metrics.merge(taken)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            self.decode_failed(count, e, pool)
+            return
+        except Exception as e:
+            log.error("Unable to decode " + str(count) + " messages: " + str(e))
+            entries, rejected = [], [("decode error", None)] * count
+        for entry in entries:
+            # Names from another process aren't interned in this one.
+            entry.names = tuple(map(sys.intern, entry.names))
+            queue.put(entry)
+        with self.lock:
+            self.pending -= count
+            self.decoded += len(entries)
+        for reason, detail in rejected:
+            self.reject(reason, detail)
 
-# We do this because the Listener object must be in the same thread that's running get_batch().
-def get_messages():
-    listener = Listener()
-    listener.get_batch(q)
 
-def check_update():
-    global update_busy, db_name, item_ids, system_ids, station_ids
-    
-    # Convert the number from the "check_update_every_x_sec" setting, which is in seconds,
-    # into easily readable hours, minutes, seconds.
-    m, s = divmod(config['check_update_every_x_sec'], 60)
-    h, m = divmod(m, 60)
-    next_check = ""
-    if h > 0:
-        next_check = str(h) + " hour"
-        if h > 1:
-            next_check += "s"
-        if m > 0 or s > 0:
-            next_check += ", "
-    if m > 0:
-        next_check += str(m) + " minute"
-        if m > 1:
-            next_check += "s"
-        if s > 0:
-            next_check += ", "                    
-    if s > 0:
-        next_check += str(s) + " second"
-        if s > 1:
-            next_check += "s"
-            
-    # The following values only need to be assigned once, no need to be in the while loop.
-    BASE_URL = plugins.eddblink_plug.BASE_URL
-    FALLBACK_URL = plugins.eddblink_plug.FALLBACK_URL
-    LISTINGS = "listings.csv"
-    listings_path = Path(LISTINGS)
-    Months = {'Jan':1, 'Feb':2, 'Mar':3, 'Apr':4, 'May':5, 'Jun':6, 'Jul':7, 'Aug':8, 'Sep':9, 'Oct':10, 'Nov':11, 'Dec':12}
-       
-    while go:
+    def reject(self, reason, detail):
+        with self.lock:
+            self.rejected[reason] += 1
+        metrics.inc('messages_rejected_total', reason = reason)
+        if detail and config['debug']:
+            reject_log.debug(detail)
+
+
+    def report(self):
+        """
+        Shows the receive and decode rates, and anything suggesting messages
+        are being lost, every reportInterval seconds, when verbose is on.
+        """
         now = time.time()
-    
-        dumpModded = 0
-        localModded = 0
+        since, received, decoded = self.lastReport
+        if not config['verbose'] or now < since + self.reportInterval:
+            return
+        with self.lock:
+            self.lastReport = (now, self.received, self.decoded)
+            log.info("Listener: " + str(int((self.received - received) / (now - since) * 10) / 10) + " messages/s received, "\
+                     + str(int((self.decoded - decoded) / (now - since) * 10) / 10) + " messages/s decoded, "\
+                     + str(self.pending) + " waiting to be decoded, " + str(self.dropped) + " dropped, "\
+                     + str(self.saturated) + " saturated bursts (RCVHWM " + str(self.subscriber.getsockopt(zmq.RCVHWM)) + "). "\
+                     + "Rejected: " + (", ".join(str(count) + " " + reason for reason, count in sorted(self.rejected.items())) or "none") + ".")
         
-        # We want to get the files from Tromador's mirror, but if it's down we'll go to EDDB.io directly, instead.         
-        if config['side'] == 'client':
+# End of 'kfsone' code.
+
+class MessageFilter(object):
+    """
+    The whitelist from the config, compiled for checking messages quickly:
+    software names are looked up in a dict instead of searching the list,
+    and the result of comparing each version to the minimum is remembered,
+    rather than parsing both versions again for every message.
+
+    Attributes:
+        minVersions         softwareName.lower() => LooseVersion of the
+                            minversion, or None if any version is allowed,
+        versions            (softwareName.lower(), softwareVersion) => whether
+                            that version is allowed, for up to maxVersions.
+    """
+
+    maxVersions = 10000
+
+    def __init__(self, whitelist):
+        self.minVersions = {}
+        for entry in whitelist:
+            # The first entry for the software is the one that counts.
+            software = entry['software'].lower()
+            if software not in self.minVersions:
+                minversion = entry.get('minversion')
+                self.minVersions[software] = LooseVersion(minversion) if minversion else None
+        self.versions = {}
+
+
+    def check(self, software, swVersion):
+        """
+        Returns None if messages from the given software and version are
+        accepted, or else the reason they aren't.
+        """
+        software = software.lower()
+        try:
+            minversion = self.minVersions[software]
+        except KeyError:
+            # Upload software not on whitelist is ignored.
+            return "software"
+        if minversion is None:
+            return None
+        # Upload software with version less than the defined minimum is ignored.
+        allowed = self.versions.get((software, swVersion))
+        if allowed is None:
             try:
-                request.urlopen(BASE_URL + LISTINGS)
-                url = BASE_URL + LISTINGS
-            except:
-                url = FALLBACK_URL + LISTINGS
-        else:
-            url = FALLBACK_URL + LISTINGS
+                allowed = not LooseVersion(swVersion) < minversion
+            except TypeError:
+                # The versions can't be compared, such as "1.a" and "1.2".
+                allowed = False
+            if len(self.versions) >= self.maxVersions:
+                self.versions.clear()
+            self.versions[(software, swVersion)] = allowed
+        return None if allowed else "version"
 
-        # Need to parse the "Last-Modified" header into a Unix-epoch, and Python's strptime()
-        # won't work because it is locale-dependent, meaning it would only work in English-
-        # speaking countries.
-        dDL = request.urlopen(url).getheader("Last-Modified").split(' ')
-        dTL = dDL[4].split(':')
+def decode_message(zdata):
+    """
+    Decompresses, parses and validates a message from the EDDN.
+    Returns (MarketPrice, None, None) for a valid market message from
+    whitelisted software, or else (None, the reason it was rejected, and
+    for messages from the wrong software, the line to write to debug.txt).
+    Doesn't use anything but the config and the MessageFilter built from it,
+    so it can be run in another process.
+    """
+    start = time.time()
+    try:
+        jsdata = zlib.decompress(zdata)
+    except Exception:
+        return None, "not compressed", None
 
-        dumpDT = datetime.datetime(int(dDL[3]), Months[dDL[2]], int(dDL[1]),\
-            hour=int(dTL[0]), minute=int(dTL[1]), second=int(dTL[2]),\
-            tzinfo=datetime.timezone.utc)
-        dumpModded = timegm(dumpDT.timetuple())
+    # Most of the EDDN's messages aren't market messages, so look for the
+    # schema in the raw message before going to the trouble of parsing it.
+    if Listener.supportedSchemaBytes not in jsdata:
+        return None, "other schema", None
 
-        # Now that we have the Unix epoch time of the dump file, get the same from the local file.
-        if Path.exists(eddbPath / listings_path):
-            localModded = (eddbPath / listings_path).stat().st_mtime
-            
-        # Trigger daily EDDB update if the dumps have updated since last run.
-        # Otherwise, go to sleep for an hour before checking again.
-        if localModded < dumpModded:
-            # TD will fail with an error if the database is in use while it's trying
-            # to do its thing, so we need to make sure that neither of the database
-            # editing methods are doing anything before running.
-            update_busy = True
-            print("EDDB update available, waiting for busy signal acknowledgement before proceeding.")
-            while not (process_ack and export_ack):
-                if config['debug']:
-                    print("Still waiting for acknowledgment.")
-                time.sleep(1)
-            print("Busy signal acknowledged, performing EDDB dump update.")
-            options = config['plugin_options']
-            if config['side'] == "server":
-                options += ",fallback"
-            trade.main(('trade.py','import','-P','eddblink','-O',options))
-            
-            # Since there's been an update, we need to redo all this.
-            del db_name, item_ids, system_ids, station_ids
-            db_name, item_ids, system_ids, station_ids = update_dicts()
-            
-            print("Update complete, turning off busy signal.")
-            update_busy = False
+    bdata = jsdata.decode()
+
+    try:
+        data = json.loads(bdata)
+    except ValueError:
+        return None, "not json", None
+
+    try:
+        schema = data["$schemaRef"]
+    except KeyError:
+        return None, "no schema", None
+    if schema != Listener.supportedSchema:
+        return None, "other schema", None
+    try:
+        header = data["header"]
+        message = data["message"]
+        system = message["systemName"].upper()
+        station = message["stationName"].upper()
+        commodities = message["commodities"]
+        timestamp = message["timestamp"]
+        software = header["softwareName"]
+        swVersion = header["softwareVersion"]
+    except (KeyError, ValueError):
+        return None, "malformed", None
+    parsed = time.time()
+    metrics.observe('parse', parsed - start)
+    reason = message_filter.check(software, swVersion)
+    metrics.observe('filter', time.time() - parsed)
+    if reason:
+        return None, reason, system + "/" + station + " rejected with:" + software + swVersion
+    # We've received real data.
+
+    # Normalize timestamps
+    timestamp = timestamp.replace("T"," ").replace("+00:00","")
+
+    try:
+        entry = MarketPrice.from_commodities(system, station, commodities, timestamp, software, swVersion)
+    except (KeyError, TypeError, ValueError, OverflowError, AttributeError):
+        # Missing or non-numeric values.
+        return None, "malformed", None
+    return entry, None, None
+
+def decode_messages(frames):
+    """
+    Decodes a list of messages from the EDDN, in a decode pool worker process.
+    Returns the list of MarketPrices, a list of (reason, debug line) for the
+    messages that were rejected, and the worker's metrics for the listener
+    to merge.
+    """
+    entries = []
+    rejected = []
+    for zdata in frames:
+        entry, reason, detail = decode_message(zdata)
+        if entry:
+            entries.append(entry)
         else:
-            print("No update, checking again in "+ next_check + ".")
-            while time.time() < now + config['check_update_every_x_sec']:
-                if config['debug']:
-                    print("Update checker is sleeping: " + str(now + config['check_update_every_x_sec'] - time.time()) + " seconds remain until next check.")
-                if not go:
-                    print("Shutting down update checker.")
-                    break
-                time.sleep(1)
-        
-        del localModded, dumpModded, now, dDL, dTL, dumpDT
-                
-def load_config():
+            rejected.append((reason, detail))
+    return entries, rejected, metrics.take()
+
+def init_decode_worker(worker_config):
     """
-    Loads the settings from 'eddblink-listener-configuration.json'. 
-    If the config_file does not exist or is missing any settings, 
-    the default will be used for any missing setting, 
-    and the config_file will be updated to include all settings,
-    preserving the existing (if any) settings' current values.
+    Sets up a decode pool worker process with what decode_message() needs,
+    since (depending on the platform) it may not have inherited it.
     """
-    
-    write_config = False
-    # Initialize config with default settings.
-    # NOTE: Whitespace added for readability.
-    #
-    # eddi has been sending bad data
-    # removed from whitelist until fixed    
-    # [eye EDIT:] 
-    # Removing it from here only keeps it from being written by default,
-    # it doesn't remove it from existing configs.
-    # That needs to be done in the validate method.
-    config = OrderedDict([\
-                            ('side', 'client'),                                                      \
-                            ('verbose', True),                                                       \
-                            ('debug', False),                                                        \
-                            ('plugin_options', "all,skipvend,force"),                                \
-                            ('check_update_every_x_sec', 3600),                                      \
-                            ('export_every_x_sec', 300),                                             \
-                            ('server_maint_every_x_hour', 12),                                          \
-                            ('export_path', './data/eddb'),                                          \
-                            ('whitelist',                                                            \
-                                [                                                                    \
-                                    OrderedDict([ ('software', 'E:D Market Connector [Windows]') ]), \
-                                    OrderedDict([ ('software', 'E:D Market Connector [Mac OS]')  ]), \
-                                    OrderedDict([ ('software', 'E:D Market Connector [Linux]')   ]), \
-#                                    OrderedDict([ ('software', 'eddi'), ('minversion', '2.2')    ]),  \
-                                    OrderedDict([ ('software', 'EDDiscovery')                    ]) \
-                                ]                                                                    \
-                            )                                                                        \
-               ])
-    
-    # Load the settings from the configuration file if it exists.
-    if Path.exists(Path("eddblink-listener-config.json")):
-        with open("eddblink-listener-config.json", "r") as fh:
+    global config, message_filter
+    config = worker_config
+    message_filter = MessageFilter(config['whitelist'])
+
+def encode_entry(entry):
+    """
+    Turns a queued MarketPrice into bytes, for the SpillQueue.
+    """
+    return json.dumps(entry.fields(), separators = (',', ':')).encode()
+
+def decode_entry(data):
+    fields = json.loads(data.decode())
+    if len(fields) == 7:
+        # Spilled by an older version, which kept the message's commodities.
+        system, station, commodities, timestamp, uploader, software, version = fields
+        return MarketPrice.from_commodities(system, station, commodities, timestamp, software, version)
+    return MarketPrice(*fields)
+
+class SpillQueue(object):
+    """
+    Disk-backed FIFO queue of market messages, used by the WorkQueue to hold
+    the messages that won't fit in memory.
+
+    The messages are stored in a folder, as a series of append-only segment
+    files of length-prefixed records. A segment is deleted once it has been
+    read to the end. Segments left from a previous run are read first, so a
+    backlog of messages survives a restart.
+
+    Attributes:
+        path                The folder the segment files are kept in,
+        segments            Numbers of the segment files, oldest first,
+        writer              File the newest segment is being written with,
+        reader              File the oldest segment is being read with,
+        count               Number of messages stored.
+    """
+
+    segmentSize = 16 << 20
+    header = struct.Struct("<I")
+
+    def __init__(self, path):
+        self.path = path
+        path.mkdir(exist_ok = True)
+        self.segments = deque(sorted(int(seg.stem) for seg in path.glob("*.seg")))
+        self.writer = None
+        self.reader = None
+        self.count = 0
+
+        # Carry on reading from where the previous run got to, if it said.
+        offset = 0
+        cursor = path / Path("cursor")
+        if cursor.exists():
             try:
-                temp = json.load(fh, object_pairs_hook=OrderedDict)
-                # For each setting in config,
-                # if file setting exists and isn't the default,
-                # overwrite config setting with file setting.
-                for setting in config:
-                    if setting in temp:
-                        if config[setting] != temp[setting]:
-                            config[setting] = temp[setting]
+                segment, offset = json.loads(cursor.read_text())
+                while self.segments and self.segments[0] < segment:
+                    self.segment_path(self.segments.popleft()).unlink()
+            except (OSError, ValueError):
+                offset = 0
+            cursor.unlink()
+        for segment in self.segments:
+            with self.segment_path(segment).open('rb') as fh:
+                if segment == self.segments[0]:
+                    fh.seek(offset)
+                while self.read_record(fh) is not None:
+                    self.count += 1
+        if self.segments:
+            self.reader = self.segment_path(self.segments[0]).open('rb')
+            self.reader.seek(offset)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def segment_path(self, segment):
+        return self.path / Path(str(segment).zfill(12) + ".seg")
+
+
+    def read_record(self, fh):
+        """
+        Returns the next record in fh, or None if there isn't a complete one.
+        """
+        start = fh.tell()
+        header = fh.read(self.header.size)
+        if len(header) == self.header.size:
+            data = fh.read(self.header.unpack(header)[0])
+            if len(data) == self.header.unpack(header)[0]:
+                return data
+        # Leave fh where it was, in case the rest of the record is still being written.
+        fh.seek(start)
+        return None
+
+
+    def write_records(self, fh, entries):
+        for entry in entries:
+            data = encode_entry(entry)
+            fh.write(self.header.pack(len(data)) + data)
+        # Flushed so the reader can see them, and they survive a crash.
+        fh.flush()
+
+
+    def append(self, entry):
+        if not self.writer or self.writer.tell() >= self.segmentSize:
+            if self.writer:
+                self.writer.close()
+            # Start at a high number, to leave room for prepend().
+            segment = self.segments[-1] + 1 if self.segments else 10 ** 9
+            self.segments.append(segment)
+            self.writer = self.segment_path(segment).open('ab')
+            if not self.reader:
+                self.reader = self.segment_path(segment).open('rb')
+        self.write_records(self.writer, (entry,))
+        self.count += 1
+
+
+    def prepend(self, entries):
+        """
+        Stores entries ahead of everything already stored. Only used when
+        shutting down, since the reader isn't moved back to them.
+        """
+        if not entries:
+            return
+        if self.reader:
+            # Drop the part of the oldest segment that has already been read,
+            # since the reader will start from the new segment.
+            if self.reader.tell():
+                remainder = self.reader.read()
+                self.reader.close()
+                if self.writer and len(self.segments) == 1:
+                    self.writer.close()
+                    self.writer = None
+                self.segment_path(self.segments[0]).write_bytes(remainder)
+            else:
+                self.reader.close()
+            self.reader = None
+        segment = self.segments[0] - 1 if self.segments else 10 ** 9
+        self.segments.appendleft(segment)
+        with self.segment_path(segment).open('wb') as fh:
+            self.write_records(fh, entries)
+        self.count += len(entries)
+        self.reader = self.segment_path(segment).open('rb')
+
+
+    def pop(self):
+        """
+        Returns the oldest stored message, or None if there aren't any.
+        """
+        while self.count and self.reader:
+            data = self.read_record(self.reader)
+            if data is not None:
+                self.count -= 1
+                return decode_entry(data)
+            if len(self.segments) == 1:
+                # Caught up with the writer.
+                return None
+            # Finished with this segment.
+            self.reader.close()
+            self.segment_path(self.segments.popleft()).unlink()
+            self.reader = self.segment_path(self.segments[0]).open('rb')
+        return None
+
+
+    def close(self):
+        """
+        Closes the files, noting where the reader got to for the next run.
+        """
+        if self.reader and self.segments:
+            (self.path / Path("cursor")).write_text(json.dumps([self.segments[0], self.reader.tell()]))
+            self.reader.close()
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+
+class WorkQueue(object):
+    """
+    Thread-safe FIFO queue that hands market messages from the listener to
+    the message processor. Consumers block on it (with a timeout) rather
+    than polling, and the queue can be bounded by a high-water mark.
+
+    Only the newest message for each station is kept: a message for a
+    station that is already queued replaces the queued one, keeping its
+    place in the queue, if it is newer, and is dropped if it is older.
+    Messages spilled to disk are coalesced as they are read back instead.
+
+    Attributes:
+        highWater           Most messages the queue will hold in memory,
+                            0 for no limit,
+        overflow            What to do with a message that arrives when the
+                            queue is at its high-water mark:
+                                'drop_oldest' drops the oldest queued message
+                                              to make room for it,
+                                'drop_newest' drops the new message,
+                                'spill'       stores it in the SpillQueue
+                                              until the queue has been
+                                              emptied down to it.
+        entries             The queued messages, oldest first, each held in
+                            a list, along with the time it was queued, so
+                            it can be replaced in place,
+        pending             Dict of (system, station) => entry list, for
+                            the messages in entries,
+        spill               SpillQueue used by the 'spill' policy,
+        enqueued            Number of messages added to the queue,
+        dequeued            Number of messages taken off the queue,
+        dropped             Number of messages dropped due to overflow,
+        spilled             Number of messages that were spilled to disk,
+        coalesced           Number of messages merged with another message
+                            for the same station.
+    """
+
+    overflowPolicies = ('drop_oldest', 'drop_newest', 'spill')
+
+    def __init__(self, highWater=0, overflow='drop_oldest', spillPath=None):
+        assert overflow in self.overflowPolicies
+        self.highWater = highWater
+        self.overflow = overflow
+        self.entries = deque()
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.woken = False
+        self.overflowing = False
+        self.closed = False
+
+        self.spill = None
+        if overflow == 'spill':
+            self.spill = SpillQueue(spillPath)
+            if len(self.spill):
+                log.info("Found " + str(len(self.spill)) + " messages left queued on disk, processing them first.")
+
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.coalesced = 0
+
+
+    def __len__(self):
+        return len(self.entries) + (len(self.spill) if self.spill is not None else 0)
+
+
+    def put(self, entry):
+        """
+        Adds entry to the end of the queue, unless the station is already
+        queued, applying the overflow policy if the queue is full. Returns
+        False if entry was dropped.
+        """
+        with self.lock:
+            self.enqueued += 1
+            key = (entry.system, entry.station)
+            # Messages going to disk can't be merged with the ones in memory,
+            # since the spilled messages for the station would be out of order.
+            spilling = self.spill is not None and len(self.spill)
+            oldEntryList = self.pending.get(key) if not spilling else None
+            if oldEntryList:
+                self.coalesced += 1
+                if oldEntryList[0].timestamp > entry.timestamp:
+                    return False
+                oldEntryList[0] = entry
+                return True
+
+            if self.spill is not None and (spilling or self.closed\
+                               or (self.highWater and len(self.entries) >= self.highWater)):
+                # Once spilling starts, everything goes on disk until the
+                # disk has been emptied, to keep the messages in order.
+                if not self.overflowing:
+                    self.overflowing = True
+                    log.info("Message queue is at its high-water mark of " + str(self.highWater)\
+                             + " messages, spilling to disk.")
+                self.spill.append(entry)
+                self.spilled += 1
+            elif self.highWater and len(self.entries) >= self.highWater:
+                if not self.overflowing:
+                    self.overflowing = True
+                    log.info("Message queue is at its high-water mark of " + str(self.highWater)\
+                             + " messages, applying '" + self.overflow + "' policy.")
+                self.dropped += 1
+                if self.overflow == 'drop_newest':
+                    return False
+                self.pop()
+                self.append(key, entry)
+            else:
+                if self.overflowing and len(self.entries) < self.highWater // 2:
+                    self.overflowing = False
+                self.append(key, entry)
+            self.cond.notify()
+        return True
+
+
+    def append(self, key, entry):
+        """
+        Adds entry to the end of the queue in memory.
+        Must be called with the lock held.
+        """
+        entryList = [entry, time.time()]
+        self.entries.append(entryList)
+        self.pending[key] = entryList
+
+
+    def pop(self):
+        """
+        Returns the oldest message, from memory or disk, or None.
+        Must be called with the lock held.
+        """
+        if self.entries:
+            entry, queued = self.entries.popleft()
+            del self.pending[(entry.system, entry.station)]
+            metrics.observe('queue_wait', time.time() - queued)
+            return entry
+        if self.spill is not None:
+            return self.spill.pop()
+        return None
+
+
+    def get_many(self, maxEntries, maxWait, timeout):
+        """
+        Waits up to timeout seconds for a message to arrive, and then up to
+        maxWait seconds more for up to maxEntries messages in total.
+        Returns the (possibly empty) list of messages, with at most one
+        per station. Returns early if wake() is called.
+        """
+        batch = []
+        # (system, station) => index in batch, for merging spilled messages.
+        stations = dict()
+        with self.lock:
+            deadline = time.time() + timeout
+            while not len(self) and not self.woken:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            deadline = time.time() + maxWait
+            while len(batch) < maxEntries and not self.woken:
+                entry = self.pop()
+                if entry is not None:
+                    key = (entry.system, entry.station)
+                    index = stations.get(key)
+                    if index is None:
+                        stations[key] = len(batch)
+                        batch.append(entry)
                     else:
-                        # If any settings don't exist in the config_file, need to update the file.
-                        write_config = True
-                if temp.get("check_delay_in_sec"):
-                    config["check_update_every_x_sec"] = temp["check_delay_in_sec"]
-                    write_config = True
-            except:
-                # If, for some reason, there's an error trying to load
-                # the config_file, treat it as if it doesn't exist.
-                write_config = True
-    else:
-        # If the config_file doesn't exist, need to make it.
-        write_config = True
+                        self.coalesced += 1
+                        if batch[index].timestamp <= entry.timestamp:
+                            batch[index] = entry
+                    self.dequeued += 1
+                    continue
+                if not batch:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            self.woken = False
+        return batch
+
+
+    def wake(self):
+        """
+        Makes any consumer waiting in get_many() return immediately.
+        """
+        with self.lock:
+            self.woken = True
+            self.cond.notify_all()
+
+
+    def close(self):
+        """
+        When spilling is enabled, moves the messages still in memory to
+        disk, ahead of any already there, so they're processed after a
+        restart. Anything put in the queue afterwards goes to disk too.
+        """
+        with self.lock:
+            self.closed = True
+            if self.spill is not None:
+                if self.entries:
+                    log.info("Saving " + str(len(self.entries)) + " queued messages to disk.")
+                self.spill.prepend([entryList[0] for entryList in self.entries])
+                self.entries.clear()
+                self.pending.clear()
+                self.spill.close()
+
+
+    def counters(self):
+        """
+        Returns a string summarizing the state of the queue.
+        """
+        with self.lock:
+            return "Queue: " + str(len(self)) + " pending, " + str(self.enqueued) + " enqueued, "\
+                 + str(self.dequeued) + " dequeued, " + str(self.coalesced) + " coalesced, "\
+                 + str(self.dropped) + " dropped"\
+                 + (", " + str(self.spilled) + " spilled to disk." if self.spill is not None else ".")
+
+
+class DBAccess(object):
+    """
+    Coordinates the threads' access to TD's database.
+
+    Any number of threads can hold shared access at the same time, but
+    exclusive access is only granted when no other thread holds either.
+    Waiting for exclusive access takes priority over new requests for
+    shared access, so the update checker and listings exporter get the
+    database as soon as the current holders are finished with it. To keep
+    things fair, threads that were already waiting for shared access when
+    exclusive access is released are let in before the next exclusive
+    holder.
+
+    The time each thread spends waiting is recorded in waits, keyed by
+    the thread's name, as [number of waits, total seconds, longest wait].
+
+    The threads' DBConnections are registered here, so they can all be closed
+    when the database file is replaced. generation goes up by one each time
+    that happens.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.connections = []
+        self.generation = 0
+        self.sharers = 0
+        self.exclusive = False
+        self.sharersWaiting = 0
+        self.exclusivesWaiting = 0
+        # Number of waiting sharers still to be let in ahead of exclusive waiters.
+        self.sharersGranted = 0
+        self.waits = {}
+
+
+    def record_wait(self, waited):
+        name = threading.current_thread().name
+        stats = self.waits.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        metrics.observe('access_wait', waited)
+        if waited >= 1 and config['verbose']:
+            log.info(name + " waited " + str(int(waited * 1000) / 1000) + " seconds for database access.")
+
+
+    @contextmanager
+    def shared(self):
+        start = time.time()
+        with self.cond:
+            self.sharersWaiting += 1
+            while self.exclusive or (self.exclusivesWaiting and not self.sharersGranted):
+                self.cond.wait()
+            self.sharersWaiting -= 1
+            if self.sharersGranted:
+                self.sharersGranted -= 1
+            self.sharers += 1
+            self.record_wait(time.time() - start)
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.sharers -= 1
+                if not self.sharers:
+                    self.cond.notify_all()
+
+
+    @contextmanager
+    def exclusive_access(self, timeout=None):
+        """
+        Waits for exclusive access, for no more than timeout seconds if it's
+        given. Yields True once access is granted, or False if the timeout
+        ran out first, in which case access isn't held.
+        """
+        start = time.time()
+        granted = False
+        with self.cond:
+            self.exclusivesWaiting += 1
+            while self.exclusive or self.sharers or self.sharersGranted:
+                remaining = None if timeout is None else start + timeout - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            else:
+                granted = True
+            self.exclusivesWaiting -= 1
+            if not granted:
+                # Let in the sharers that were held back while this waited.
+                self.cond.notify_all()
+            else:
+                self.exclusive = True
+                self.record_wait(time.time() - start)
+        if not granted:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            with self.cond:
+                self.exclusive = False
+                self.sharersGranted = self.sharersWaiting
+                self.cond.notify_all()
+
+
+    def register(self, connection):
+        with self.cond:
+            self.connections.append(connection)
+
+
+    def close_connections(self):
+        """
+        Closes every registered DBConnection, so the database file can be
+        replaced. They're opened again the next time they're used.
+        Must only be called while holding exclusive access.
+        """
+        assert self.exclusive
+        with self.cond:
+            for connection in self.connections:
+                connection.close()
+            self.generation += 1
+
+
+    def report(self):
+        """
+        Returns a string summarizing the wait times of each thread.
+        """
+        with self.cond:
+            return "Database wait times: " + "; ".join(
+                name + ": " + str(stats[0]) + " waits, " + str(int(stats[1] * 1000) / 1000)\
+                + " seconds total, " + str(int(stats[2] * 1000) / 1000) + " seconds longest"
+                for name, stats in sorted(self.waits.items())) + "."
+
+
+def connect_db(path=None):
+    """
+    Opens a connection to TD's database, (or the database at path,) in
+    autocommit mode, so transactions are managed by hand.
+    The connection can be closed from another thread, which
+    DBAccess.close_connections() relies on.
+    """
+    conn = sqlite3.connect(str(path or dbPath), check_same_thread=False)
+    conn.isolation_level = None
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+class DBConnection(object):
+    """
+    A thread's connection to TD's database, which is opened when first
+    needed, and opened again whenever the database file has been replaced.
+    Only use the connection while holding access to the database.
+
+    Attributes:
+        setup               Called with each newly opened connection,
+        conn                The current connection, if open,
+        generation          The DBAccess generation conn was opened in.
+    """
+
+    def __init__(self, setup=None):
+        self.setup = setup
+        self.conn = None
+        self.generation = None
+        db_access.register(self)
+
+
+    def get(self):
+        if self.generation != db_access.generation:
+            self.close()
+            self.conn = connect_db()
+            if self.setup:
+                self.setup(self.conn)
+            self.generation = db_access.generation
+        return self.conn
+
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+def db_execute(db, sql_cmd, args = None):
+    cur = db.cursor()
+    success = False
+    result = None
+    locked = None
+    while go and not success:
+        try:
+            if args:
+                result = cur.execute(sql_cmd, args)
+            else:
+                result = cur.execute(sql_cmd)
+            success = True
+        except sqlite3.OperationalError as e:
+                if "locked" not in str(e):
+                    success = True
+                    raise sqlite3.OperationalError(e)
+                else:
+                    log.info("Database is locked, waiting for access.")
+                    metrics.inc('db_locked_total')
+                    locked = locked or time.time()
+                    time.sleep(1)
+    if locked:
+        metrics.observe('lock_wait', time.time() - locked)
+    return result
     
-        
-    # If the config_file doesn't exist, or if it is missing
-    # one or more settings (such as might happen in an upgrade),
-    # write the current configuration to the file.
-    if write_config:
-        with open("eddblink-listener-config.json", "w") as config_file:
-            json.dump(config, config_file, indent = 4)
-            
-    # We now have a config that has valid values for all the settings,
-    # even if the setting was not found in the config_file, and the 
-    # config_file has been updated if necessary with all previously 
-    # missing settings set to default values.
-    return config
 
-def validate_config():
+class UpdateProbe(object):
     """
-    Checks to make sure the loaded config contains valid values.
-    If it finds any invalid, it marks that as such in the config_file
-    so the default value is used on reload, and then reloads the config.
+    Finds out when files on a web server were last modified, without
+    downloading them.
+
+    Uses HEAD requests over kept-alive connections, one per server, and
+    once a file's Last-Modified time (and ETag, if any) is known, makes
+    the requests conditional with If-Modified-Since/If-None-Match, so an
+    unchanged file costs the server nothing but a "304 Not Modified".
+    Redirects are followed, up to maxRedirects of them, and what's known is
+    kept for the URL they lead to.
+
+    Attributes:
+        timeout             Seconds to wait on the server before giving up,
+        connections         The open connections, keyed by (scheme, host),
+        known               What's known about each URL probed so far, as
+                            {url: (Unix epoch, Last-Modified, ETag)}.
     """
-    global config
-    valid = True
-    with open("eddblink-listener-config.json", "r") as fh:
-        config_file = fh.read()
+
+    maxRedirects = 5
+    redirects = (301, 302, 303, 307, 308)
+
+
+    def __init__(self, timeout=30.):
+        self.timeout = timeout
+        self.connections = {}
+        self.known = {}
+
+
+    def connection(self, scheme, host):
+        conn = self.connections.get((scheme, host))
+        if not conn:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(host, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(host, timeout=self.timeout)
+            self.connections[(scheme, host)] = conn
+        return conn
+
+
+    def disconnect(self, scheme, host):
+        conn = self.connections.pop((scheme, host), None)
+        if conn:
+            conn.close()
+
+
+    def request(self, method, url, headers):
+        """
+        Makes a request, retrying once on a new connection in case the
+        server closed the kept-alive one. Returns the response, which
+        has already been read.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        for attempt in range(2):
+            conn = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                if method == 'HEAD':
+                    response.read()
+                else:
+                    # We only want the headers, so don't download the body,
+                    # which means the connection can't be reused.
+                    self.disconnect(parts.scheme, parts.netloc)
+                return response
+            except (http.client.HTTPException, OSError):
+                self.disconnect(parts.scheme, parts.netloc)
+                if attempt:
+                    raise
+
+
+    def last_modified(self, url):
+        """
+        Returns the Unix epoch url was last modified at.
+        Raises OSError or http.client.HTTPException if the server can't
+        be reached or doesn't give a usable answer.
+        """
+        target = url
+        for _ in range(self.maxRedirects + 1):
+            headers = {}
+            known = self.known.get(target)
+            if known:
+                headers['If-Modified-Since'] = known[1]
+                if known[2]:
+                    headers['If-None-Match'] = known[2]
+
+            response = self.request('HEAD', target, headers)
+            if response.status in (405, 501):
+                # Server doesn't do HEAD, so ask for the file and hang up after the headers.
+                response = self.request('GET', target, headers)
+            if response.status not in self.redirects:
+                break
+            location = response.getheader("Location")
+            if not location:
+                raise http.client.HTTPException(target + ": " + str(response.status) + " redirect without a Location")
+            target = urllib.parse.urljoin(target, location)
+        else:
+            raise http.client.HTTPException(url + ": more than " + str(self.maxRedirects) + " redirects")
+
+        if response.status == 304 and known:
+            return known[0]
+        if response.status != 200:
+            raise http.client.HTTPException(target + ": " + str(response.status) + " " + response.reason)
+
+        # email.utils parses HTTP dates whatever the locale, unlike strptime().
+        modified = response.getheader("Last-Modified")
+        try:
+            epoch = timegm(email.utils.parsedate_to_datetime(modified).utctimetuple())
+        except (TypeError, ValueError, IndexError):
+            raise http.client.HTTPException(target + ": bad Last-Modified header '" + str(modified) + "'")
+        self.known[target] = (epoch, modified, response.getheader("ETag"))
+        return epoch
+
+
+def wait_for_shutdown(timeout):
+    """
+    Sleeps for timeout seconds, or until the shutdown signal is sent.
+    Returns False if the shutdown signal has been sent.
+    """
+    with signals:
+        if go:
+            signals.wait(timeout)
+    return go
+
+# We do this because the Listener object must be in the same thread that's running get_batch().
+def get_messages():
+    if not config['decode_workers']:
+        listener = Listener()
+        if config['listener_mode'] == 'stream':
+            listener.get_stream(q)
+        else:
+            listener.get_batch(q)
+        return
+
+    def new_pool():
+        # Spawned rather than forked, since forking a process
+        # with other threads running isn't safe.
+        return concurrent.futures.ProcessPoolExecutor(config['decode_workers'], multiprocessing.get_context('spawn'),
+                                                      init_decode_worker, (config,))
+
+    # The work queue does the deduplicating, so there's no need to
+    # hold on to the messages for a batch window.
+    listener = Listener(minBatchTime=1., maxBatchTime=1.)
+    listener.get_frames(q, new_pool)
+
+def check_update():
+    global resolver, full_export_due
     
-    # For each of these settings, if the value is invalid, mark the key.
+    # Convert the number from the "check_update_every_x_sec" setting, which is in seconds,
+    # into easily readable hours, minutes, seconds.
+    m, s = divmod(config['check_update_every_x_sec'], 60)
+    h, m = divmod(m, 60)
+    next_check = ""
+    if h > 0:
+        next_check = str(h) + " hour"
+        if h > 1:
+            next_check += "s"
+        if m > 0 or s > 0:
+            next_check += ", "
+    if m > 0:
+        next_check += str(m) + " minute"
+        if m > 1:
+            next_check += "s"
+        if s > 0:
+            next_check += ", "                    
+    if s > 0:
+        next_check += str(s) + " second"
+        if s > 1:
+            next_check += "s"
+            
+    # The following values only need to be assigned once, no need to be in the while loop.
+    BASE_URL = plugins.eddblink_plug.BASE_URL
+    FALLBACK_URL = plugins.eddblink_plug.FALLBACK_URL
+    LISTINGS = "listings.csv"
+    listings_path = Path(LISTINGS)
+    probe = UpdateProbe()
+    # Seconds to wait before trying again when the update check fails,
+    # doubling with each failure in a row up to the normal check delay.
+    backoff = 0
+    # The time of the dump a shadow import failed to bring in. The plugin has
+    # already downloaded it by then, so the local file looks up to date, and
+    # the import has to be retried for as long as it's still the latest dump.
+    failed_dump = 0
+       
+    while go:
+        now = time.time()
+    
+        dumpModded = 0
+        localModded = 0
+        
+        # We want to get the files from Tromador's mirror, but if it's down we'll go to EDDB.io directly, instead.         
+        try:
+            if config['side'] == 'client':
+                try:
+                    dumpModded = probe.last_modified(BASE_URL + LISTINGS)
+                except (OSError, http.client.HTTPException) as e:
+                    if config['debug']:
+                        log.info("Unable to check mirror, using fallback: " + str(e))
+                    dumpModded = probe.last_modified(FALLBACK_URL + LISTINGS)
+            else:
+                dumpModded = probe.last_modified(FALLBACK_URL + LISTINGS)
+            backoff = 0
+        except (OSError, http.client.HTTPException) as e:
+            backoff = min(max(backoff * 2, 60), config['check_update_every_x_sec'])
+            log.info("Unable to check for EDDB update, trying again in " + str(backoff) + " seconds: " + str(e))
+            if not wait_for_shutdown(backoff):
+                log.info("Shutting down update checker.")
+            continue
+
+        # Now that we have the Unix epoch time of the dump file, get the same from the local file.
+        if Path.exists(eddbPath / listings_path):
+            localModded = (eddbPath / listings_path).stat().st_mtime
+            
+        # Trigger daily EDDB update if the dumps have updated since last run.
+        # Otherwise, go to sleep for an hour before checking again.
+        if localModded < dumpModded or (failed_dump and failed_dump == dumpModded):
+            options = config['plugin_options']
+            if config['side'] == "server":
+                options += ",fallback"
+            if config['import_mode'] == 'shadow':
+                log.info("EDDB update available.")
+                if not shadow_import(options):
+                    if not go:
+                        log.info("Shutting down update checker.")
+                        break
+                    # Try again next time.
+                    failed_dump = dumpModded
+                    log.info("EDDB update will be tried again in " + next_check + ".")
+                    wait_for_shutdown(config['check_update_every_x_sec'])
+                    continue
+                failed_dump = 0
+            else:
+                # TD will fail with an error if the database is in use while it's trying
+                # to do its thing, so we need exclusive access to the database before running.
+                log.info("EDDB update available, waiting for database access before proceeding.")
+                with db_access.exclusive_access():
+                    if not go:
+                        log.info("Shutting down update checker.")
+                        break
+                    log.info("Database access granted, performing EDDB dump update.")
+                    trade.main(('trade.py','import','-P','eddblink','-O',options))
+                    # The import may have brought newer markets for some stations.
+                    freshness.invalidate()
+                    snapshots.clear()
+                    avg_prices.invalidate()
+            
+            # The update changes listings all over the place,
+            # so the next export can't be a delta.
+            with changes_lock:
+                full_export_due = True
+                
+            log.info("Update complete, releasing database.")
+            if config['verbose']:
+                log.info(db_access.report())
+
+            # Since there's been an update, we need to redo the lookup tables.
+            # The message processor carries on using the current ones until
+            # the new ones are ready to replace them.
+            resolver = update_dicts(resolver)
+            log.info("Now using lookup tables version " + str(resolver.version) + ".")
+            # The new tables might know the stations of the parked messages.
+            parked = unknowns.release(resolver.version)
+            if parked:
+                log.info("Retrying " + str(len(parked)) + " messages for stations that were unknown.")
+            for entry in parked:
+                q.put(entry)
+        else:
+            log.info("No update, checking again in "+ next_check + ".")
+            with signals:
+                while time.time() < now + config['check_update_every_x_sec']:
+                    if config['debug']:
+                        log.info("Update checker is sleeping: " + str(now + config['check_update_every_x_sec'] - time.time()) + " seconds remain until next check.")
+                    if not go:
+                        log.info("Shutting down update checker.")
+                        break
+                    # Debug mode reports the time remaining every second.
+                    signals.wait(1 if config['debug'] else now + config['check_update_every_x_sec'] - time.time())
+                
+def replay_journal(conn, final, fresh):
+    """
+    Writes the messages the message processor has written to the live
+    database since the shadow import began to the shadow database as well,
+    skipping any that are older than the updated data, using the
+    StationFreshness fresh.
+    Unless final is set, it stops once the journal is nearly caught up,
+    leaving the rest for the final replay, which is done with exclusive
+    access so nothing more can be added to it.
+    Returns the number of messages replayed.
+    """
+    replayed = 0
+    while True:
+        with journal_lock:
+            batch = shadow_journal[:config['batch_max_messages']]
+            del shadow_journal[:len(batch)]
+        if batch:
+            write_batch(conn, batch, fresh)
+            replayed += len(batch)
+        if not batch or (len(batch) < config['batch_max_messages'] and not final):
+            return replayed
+
+def shadow_import(options):
+    """
+    Runs the EDDBlink plugin against a copy of the database, in a separate
+    process, while the message processor carries on writing to the live
+    database. Every message written in the meantime is replayed onto the
+    copy, which then replaces the live database. Only the final replay and
+    the swap itself need exclusive access to the database, which is only
+    asked for briefly at a time, so that a listings export holding the
+    database doesn't leave the message processor waiting behind the swap.
+    Returns True if the live database was replaced. Otherwise, the copy is
+    deleted.
+    """
+    global shadow_journal
+
+    shadow_path = dbPath.with_name(dbPath.name + ".shadow")
+    remove_shadow(shadow_path)
+
+    # Start recording messages before making the copy, so that nothing
+    # committed after the copy's snapshot was taken can be missed.
+    with journal_lock:
+        shadow_journal = []
+    shadow = None
+    swapped = False
+    try:
+        log.info("Copying database for EDDB dump update.")
+        start = time.time()
+        with db_access.shared():
+            live = connect_db()
+            shadow = sqlite3.connect(str(shadow_path))
+            live.backup(shadow)
+            shadow.close()
+            live.close()
+        log.info("Database copied in " + str(int((time.time() - start) * 1000) / 1000) + " seconds, performing EDDB dump update on copy.")
+
+        result = subprocess.run([sys.executable, "trade.py", "import", "-P", "eddblink", "-O", options, "--db", str(shadow_path)],
+                                cwd=str(Path(trade.__file__).resolve().parent))
+        if result.returncode != 0:
+            log.error("EDDB dump update failed with exit code " + str(result.returncode) + ", keeping current database.")
+            return False
+        if not go:
+            return False
+
+        shadow = connect_db(shadow_path)
+        log.info("Replaying " + str(len(shadow_journal)) + " messages processed during update onto copy.")
+        # The copy has its own markets, so it needs its own freshness checks.
+        fresh = StationFreshness(config['freshness_cache_size'])
+        replay_journal(shadow, False, fresh)
+
+        log.info("Waiting for database access to swap in updated database.")
+        while True:
+            with db_access.exclusive_access(0.25) as granted:
+                if granted:
+                    start = time.time()
+                    replayed = replay_journal(shadow, True, fresh)
+                    # The live database is always in WAL mode for shadow imports.
+                    shadow.execute("PRAGMA journal_mode = WAL")
+                    shadow.close()
+                    db_access.close_connections()
+                    live_wal = dbPath.with_name(dbPath.name + "-wal")
+                    if live_wal.exists() and live_wal.stat().st_size:
+                        # Something else still has the database open, and its WAL
+                        # would be applied to the new database file if we swapped it in.
+                        log.error("Database is in use by another program, unable to swap in updated database.")
+                        return False
+                    os.replace(str(shadow_path), str(dbPath))
+                    swapped = True
+                    freshness.invalidate()
+                    snapshots.clear()
+                    avg_prices.invalidate()
+                    log.info("Swapped in updated database in " + str(int((time.time() - start) * 1000) / 1000)\
+                             + " seconds, after replaying " + str(replayed) + " more messages.")
+                    return True
+            # Another thread has the database for longer, such as the
+            # listings exporter, so keep the copy caught up and try again.
+            if not wait_for_shutdown(5):
+                return False
+            replay_journal(shadow, False, fresh)
+    finally:
+        with journal_lock:
+            shadow_journal = None
+        if not swapped:
+            if shadow:
+                shadow.close()
+            remove_shadow(shadow_path)
+
+def remove_shadow(shadow_path):
+    """
+    Deletes the copy of the database made for a shadow import, if there is
+    one, along with its WAL and shared memory files.
+    """
+    for path in (shadow_path, shadow_path.with_name(shadow_path.name + "-wal"),
+                 shadow_path.with_name(shadow_path.name + "-shm")):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+def load_config():
+    """
+    Loads the settings from 'eddblink-listener-configuration.json'. 
+    If the config_file does not exist or is missing any settings, 
+    the default will be used for any missing setting, 
+    and the config_file will be updated to include all settings,
+    preserving the existing (if any) settings' current values.
+    """
+    
+    write_config = False
+    # Initialize config with default settings.
+    # NOTE: Whitespace added for readability.
+    #
+    # eddi has been sending bad data
+    # removed from whitelist until fixed    
+    # [eye EDIT:] 
+    # Removing it from here only keeps it from being written by default,
+    # it doesn't remove it from existing configs.
+    # That needs to be done in the validate method.
+    config = OrderedDict([\
+                            ('side', 'client'),                                                      \
+                            ('verbose', True),                                                       \
+                            ('debug', False),                                                        \
+                            ('plugin_options', "all,skipvend,force"),                                \
+                            ('import_mode', 'inplace'),                                              \
+                            ('check_update_every_x_sec', 3600),                                      \
+                            ('export_every_x_sec', 300),                                             \
+                            ('export_full_every_x_sec', 3600),                                       \
+                            ('server_maint_every_x_hour', 12),                                          \
+                            ('wal_checkpoint_every_x_sec', 60),                                      \
+                            ('batch_max_messages', 100),                                             \
+                            ('batch_max_ms', 500),                                                   \
+                            ('queue_high_water', 50000),                                             \
+                            ('queue_overflow_policy', 'drop_oldest'),                                \
+                            ('freshness_cache_size', 200000),                                        \
+                            ('snapshot_cache_size', 20000),                                          \
+                            ('resolve_workers', 1),                                                  \
+                            ('resolve_pool', 'thread'),                                              \
+                            ('decode_workers', 0),                                                   \
+                            ('listener_mode', 'stream'),                                             \
+                            ('avg_price_flush_every_x_sec', 60),                                     \
+                            ('unknown_ttl_sec', 3600),                                               \
+                            ('unknown_max_parked', 20000),                                           \
+                            ('log_queue_size', 10000),                                               \
+                            ('log_sample_every', OrderedDict()),                                     \
+                            ('log_max_per_minute', 0),                                               \
+                            ('log_file_max_mb', 10),                                                 \
+                            ('log_file_backups', 3),                                                 \
+                            ('metrics_port', 0),                                                     \
+                            ('metrics_summary_every_x_sec', 300),                                    \
+                            ('export_path', './data/eddb'),                                          \
+                            ('whitelist',                                                            \
+                                [                                                                    \
+                                    OrderedDict([ ('software', 'E:D Market Connector [Windows]') ]), \
+                                    OrderedDict([ ('software', 'E:D Market Connector [Mac OS]')  ]), \
+                                    OrderedDict([ ('software', 'E:D Market Connector [Linux]')   ]), \
+#                                    OrderedDict([ ('software', 'eddi'), ('minversion', '2.2')    ]),  \
+                                    OrderedDict([ ('software', 'EDDiscovery')                    ]) \
+                                ]                                                                    \
+                            )                                                                        \
+               ])
+    
+    # Load the settings from the configuration file if it exists.
+    if Path.exists(Path("eddblink-listener-config.json")):
+        with open("eddblink-listener-config.json", "r") as fh:
+            try:
+                temp = json.load(fh, object_pairs_hook=OrderedDict)
+                # For each setting in config,
+                # if file setting exists and isn't the default,
+                # overwrite config setting with file setting.
+                for setting in config:
+                    if setting in temp:
+                        if config[setting] != temp[setting]:
+                            config[setting] = temp[setting]
+                    else:
+                        # If any settings don't exist in the config_file, need to update the file.
+                        write_config = True
+                if temp.get("check_delay_in_sec"):
+                    config["check_update_every_x_sec"] = temp["check_delay_in_sec"]
+                    write_config = True
+            except:
+                # If, for some reason, there's an error trying to load
+                # the config_file, treat it as if it doesn't exist.
+                write_config = True
+    else:
+        # If the config_file doesn't exist, need to make it.
+        write_config = True
+    
+        
+    # If the config_file doesn't exist, or if it is missing
+    # one or more settings (such as might happen in an upgrade),
+    # write the current configuration to the file.
+    if write_config:
+        with open("eddblink-listener-config.json", "w") as config_file:
+            json.dump(config, config_file, indent = 4)
+            
+    # We now have a config that has valid values for all the settings,
+    # even if the setting was not found in the config_file, and the 
+    # config_file has been updated if necessary with all previously 
+    # missing settings set to default values.
+    return config
+
+def validate_config():
+    """
+    Checks to make sure the loaded config contains valid values.
+    If it finds any invalid, it marks that as such in the config_file
+    so the default value is used on reload, and then reloads the config.
+    """
+    global config
+    valid = True
+    with open("eddblink-listener-config.json", "r") as fh:
+        config_file = fh.read()
+    
+    # For each of these settings, if the value is invalid, mark the key.
     config['side'] = config['side'].lower()
     if config['side'] != 'server' and config['side'] != 'client':
         valid = False
@@ -486,286 +1971,1640 @@ def validate_config():
         valid = False
         config_file = config_file.replace('"verbose"','"verbose_invalid"')
 
-    if not isinstance(config["debug"], bool):
-        valid = False
-        config_file = config_file.replace('"debug"','"debug_invalid"')
-        
-    # For this one, rather than completely replace invalid values with the default,
-    # check to see if any of the values are valid, and keep them, prepending the
-    # default values to the setting if they aren't already in the setting.
-    if isinstance(config['plugin_options'], str):
-        options = config['plugin_options'].split(',')
-        valid_options = ""
-        for option in options:
-            if option in ['item','system','station','ship','shipvend',\
-                          'upgrade','upvend','listings','all','clean',\
-                          'skipvend','force','fallback','progbar','solo']:
-                if valid_options != "":
-                    valid_options += ","
-                valid_options += option
+    if not isinstance(config["debug"], bool):
+        valid = False
+        config_file = config_file.replace('"debug"','"debug_invalid"')
+        
+    # For this one, rather than completely replace invalid values with the default,
+    # check to see if any of the values are valid, and keep them, prepending the
+    # default values to the setting if they aren't already in the setting.
+    if isinstance(config['plugin_options'], str):
+        options = config['plugin_options'].split(',')
+        valid_options = ""
+        for option in options:
+            if option in ['item','system','station','ship','shipvend',\
+                          'upgrade','upvend','listings','all','clean',\
+                          'skipvend','force','fallback','progbar','solo']:
+                if valid_options != "":
+                    valid_options += ","
+                valid_options += option
+            else:
+                valid = False
+        if not valid:
+            if valid_options.find("force") == -1:
+                valid_options = "force," + valid_options 
+            if valid_options.find("skipvend") == -1:
+                valid_options = "skipvend," + valid_options 
+            if valid_options.find("all") == -1:
+                valid_options = "all," + valid_options 
+            config_file = config_file.replace(config['plugin_options'],valid_options)
+    else:
+        valid = False
+        config_file = config_file.replace('"plugin_options"','"plugin_options_invalid"')
+        
+    if config['import_mode'] not in ('inplace', 'shadow'):
+        valid = False
+        config_file = config_file.replace('"import_mode"','"import_mode_invalid"')
+        
+    if isinstance(config['check_update_every_x_sec'], int):
+        if config['check_update_every_x_sec'] < 1:
+            valid = False
+            config_file = config_file.replace('"check_update_every_x_sec"','"check_update_every_x_sec_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"check_update_every_x_sec"','"check_update_every_x_sec_invalid"')
+        
+    if isinstance(config['export_every_x_sec'], int):
+        if config['export_every_x_sec'] < 1:
+            valid = False
+            config_file = config_file.replace('"export_every_x_sec"','"export_every_x_sec_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"export_every_x_sec"','"export_every_x_sec_invalid"')
+    
+    if isinstance(config['export_full_every_x_sec'], int):
+        if config['export_full_every_x_sec'] < 1:
+            valid = False
+            config_file = config_file.replace('"export_full_every_x_sec"','"export_full_every_x_sec_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"export_full_every_x_sec"','"export_full_every_x_sec_invalid"')
+    
+    if isinstance(config['server_maint_every_x_hour'], (int,float)):
+        if config['server_maint_every_x_hour'] < 1 or config['server_maint_every_x_hour'] > 24:
+            valid = False
+            config_file = config_file.replace('"server_maint_every_x_hour"','"server_maint_every_x_hour_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"server_maint_every_x_hour"','"server_maint_every_x_hour_invalid"')
+    
+    if isinstance(config['wal_checkpoint_every_x_sec'], int):
+        if config['wal_checkpoint_every_x_sec'] < 1:
+            valid = False
+            config_file = config_file.replace('"wal_checkpoint_every_x_sec"','"wal_checkpoint_every_x_sec_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"wal_checkpoint_every_x_sec"','"wal_checkpoint_every_x_sec_invalid"')
+    
+    if isinstance(config['batch_max_messages'], int):
+        if config['batch_max_messages'] < 1:
+            valid = False
+            config_file = config_file.replace('"batch_max_messages"','"batch_max_messages_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"batch_max_messages"','"batch_max_messages_invalid"')
+    
+    if isinstance(config['batch_max_ms'], int):
+        if config['batch_max_ms'] < 0:
+            valid = False
+            config_file = config_file.replace('"batch_max_ms"','"batch_max_ms_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"batch_max_ms"','"batch_max_ms_invalid"')
+    
+    if isinstance(config['queue_high_water'], int):
+        if config['queue_high_water'] < 0:
+            valid = False
+            config_file = config_file.replace('"queue_high_water"','"queue_high_water_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"queue_high_water"','"queue_high_water_invalid"')
+    
+    if config['queue_overflow_policy'] not in WorkQueue.overflowPolicies:
+        valid = False
+        config_file = config_file.replace('"queue_overflow_policy"','"queue_overflow_policy_invalid"')
+    
+    if isinstance(config['freshness_cache_size'], int):
+        if config['freshness_cache_size'] < 0:
+            valid = False
+            config_file = config_file.replace('"freshness_cache_size"','"freshness_cache_size_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"freshness_cache_size"','"freshness_cache_size_invalid"')
+    
+    if isinstance(config['snapshot_cache_size'], int):
+        if config['snapshot_cache_size'] < 0:
+            valid = False
+            config_file = config_file.replace('"snapshot_cache_size"','"snapshot_cache_size_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"snapshot_cache_size"','"snapshot_cache_size_invalid"')
+    
+    if isinstance(config['resolve_workers'], int):
+        if config['resolve_workers'] < 1:
+            valid = False
+            config_file = config_file.replace('"resolve_workers"','"resolve_workers_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"resolve_workers"','"resolve_workers_invalid"')
+    
+    if config['resolve_pool'] not in ('thread', 'process'):
+        valid = False
+        config_file = config_file.replace('"resolve_pool"','"resolve_pool_invalid"')
+    
+    if isinstance(config['decode_workers'], int):
+        if config['decode_workers'] < 0:
+            valid = False
+            config_file = config_file.replace('"decode_workers"','"decode_workers_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"decode_workers"','"decode_workers_invalid"')
+    
+    if config['listener_mode'] not in ('stream', 'batch'):
+        valid = False
+        config_file = config_file.replace('"listener_mode"','"listener_mode_invalid"')
+    
+    if isinstance(config['avg_price_flush_every_x_sec'], int):
+        if config['avg_price_flush_every_x_sec'] < 0:
+            valid = False
+            config_file = config_file.replace('"avg_price_flush_every_x_sec"','"avg_price_flush_every_x_sec_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"avg_price_flush_every_x_sec"','"avg_price_flush_every_x_sec_invalid"')
+    
+    if isinstance(config['unknown_ttl_sec'], int):
+        if config['unknown_ttl_sec'] < 0:
+            valid = False
+            config_file = config_file.replace('"unknown_ttl_sec"','"unknown_ttl_sec_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"unknown_ttl_sec"','"unknown_ttl_sec_invalid"')
+    
+    if isinstance(config['unknown_max_parked'], int):
+        if config['unknown_max_parked'] < 0:
+            valid = False
+            config_file = config_file.replace('"unknown_max_parked"','"unknown_max_parked_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"unknown_max_parked"','"unknown_max_parked_invalid"')
+    
+    if isinstance(config['log_queue_size'], int):
+        if config['log_queue_size'] < 0:
+            valid = False
+            config_file = config_file.replace('"log_queue_size"','"log_queue_size_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"log_queue_size"','"log_queue_size_invalid"')
+    
+    if isinstance(config['log_sample_every'], dict):
+        for every in config['log_sample_every'].values():
+            if not isinstance(every, int) or every < 1:
+                valid = False
+                config_file = config_file.replace('"log_sample_every"','"log_sample_every_invalid"')
+                break
+    else:
+        valid = False
+        config_file = config_file.replace('"log_sample_every"','"log_sample_every_invalid"')
+    
+    if isinstance(config['log_max_per_minute'], int):
+        if config['log_max_per_minute'] < 0:
+            valid = False
+            config_file = config_file.replace('"log_max_per_minute"','"log_max_per_minute_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"log_max_per_minute"','"log_max_per_minute_invalid"')
+    
+    if isinstance(config['log_file_max_mb'], int):
+        if config['log_file_max_mb'] < 0:
+            valid = False
+            config_file = config_file.replace('"log_file_max_mb"','"log_file_max_mb_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"log_file_max_mb"','"log_file_max_mb_invalid"')
+    
+    if isinstance(config['log_file_backups'], int):
+        if config['log_file_backups'] < 0:
+            valid = False
+            config_file = config_file.replace('"log_file_backups"','"log_file_backups_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"log_file_backups"','"log_file_backups_invalid"')
+    
+    if isinstance(config['metrics_port'], int):
+        if config['metrics_port'] < 0 or config['metrics_port'] > 65535:
+            valid = False
+            config_file = config_file.replace('"metrics_port"','"metrics_port_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"metrics_port"','"metrics_port_invalid"')
+    
+    if isinstance(config['metrics_summary_every_x_sec'], int):
+        if config['metrics_summary_every_x_sec'] < 0:
+            valid = False
+            config_file = config_file.replace('"metrics_summary_every_x_sec"','"metrics_summary_every_x_sec_invalid"')
+    else:
+        valid = False
+        config_file = config_file.replace('"metrics_summary_every_x_sec"','"metrics_summary_every_x_sec_invalid"')
+    
+    if not Path.exists(Path(config['export_path'])):
+        valid = False
+        config_file = config_file.replace('"export_path"','"export_path_invalid"')
+    
+    # Here, we get rid of 'eddi' in existing configs.
+    for entry in config['whitelist']:
+        if entry['software'].lower() == 'eddi':
+            config_file = config_file.replace(',\n        {\n            "software": "eddi",\n            "minversion": "2.2"\n        }','')
+            valid = False
+            
+    if not valid:
+        # Before we reload the config to set the invalid values back to default,
+        # we need to write the changes we made to the file.
+        with open("eddblink-listener-config.json", "w") as fh:
+            fh.write(config_file)
+        config = load_config()
+    
+
+# same SQL every time
+updStmt = "UPDATE Station SET system_id = ? WHERE station_id = ?"
+selStmt = (
+    "SELECT item_id,"
+    " demand_price, demand_units, demand_level,"
+    " supply_price, supply_units, supply_level,"
+    " modified, from_live"
+    " FROM StationItem WHERE station_id = ?"
+)
+delStmt = "DELETE FROM StationItem WHERE station_id = ? AND item_id = ?"
+insStmt = (
+    "INSERT OR IGNORE INTO StationItem("
+    " station_id, item_id, modified,"
+    " demand_price, demand_units, demand_level,"
+    " supply_price, supply_units, supply_level, from_live)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)"
+)
+chgStmt = (
+    "UPDATE StationItem SET modified = ?,"
+    " demand_price = ?, demand_units = ?, demand_level = ?,"
+    " supply_price = ?, supply_units = ?, supply_level = ?, from_live = 1"
+    " WHERE station_id = ? AND item_id = ?"
+)
+touchStmt = "UPDATE StationItem SET modified = ?, from_live = 1 WHERE station_id = ? AND item_id = ?"
+touchStationStmt = "UPDATE StationItem SET modified = ?, from_live = 1 WHERE station_id = ?"
+avgStmt = "UPDATE Item SET avg_price = ? WHERE item_id = ?"
+
+class RowCounts(namedtuple('RowCounts', [
+        'inserted',
+        'updated',
+        'refreshed',
+        'deleted',
+        'unchanged',
+        ])):
+    """
+    How many StationItem rows a market message touched, and how:
+    inserted    new items at the station,
+    updated     items whose prices/units/levels changed,
+    refreshed   items whose prices didn't change, only the timestamp,
+    deleted     items no longer sold or bought at the station,
+    unchanged   items that didn't need writing at all.
+    """
+    def __str__(self):
+        return str(self.updated) + " updated, " + str(self.inserted) + " inserted, "\
+             + str(self.refreshed) + " refreshed, " + str(self.deleted) + " deleted, "\
+             + str(self.unchanged) + " unchanged"
+
+class StationFreshness(object):
+    """
+    Remembers when each station's market was last written, so that messages
+    that aren't newer, such as ones delayed by a relay, can be rejected
+    before they overwrite newer data.
+
+    It holds up to maxSize stations, dropping the least recently used ones
+    when full, 0 meaning no limit. A station that isn't in it is looked up
+    in the database. It is filled from the database the first time it is
+    used, and again after invalidate() is called, which is done whenever
+    the database is updated by something other than the message processor.
+
+    Attributes:
+        modified            OrderedDict of station_id => the "modified"
+                            timestamp of its newest StationItem row,
+        stale               Whether modified needs filling again,
+        rejected            Number of messages rejected, by reason.
+    """
+
+    latestStmt = "SELECT MAX(modified) FROM StationItem WHERE station_id = ?"
+
+    def __init__(self, maxSize=0):
+        self.maxSize = maxSize
+        self.modified = OrderedDict()
+        self.stale = True
+        self.rejected = defaultdict(int)
+
+
+    def invalidate(self):
+        self.stale = True
+
+
+    def warm(self, curs):
+        """
+        Fills the cache with the most recently updated stations in the database.
+        """
+        sql = "SELECT station_id, MAX(modified) AS latest FROM StationItem GROUP BY station_id"
+        if self.maxSize:
+            sql += " ORDER BY latest DESC LIMIT " + str(self.maxSize)
+        self.modified = OrderedDict(reversed(curs.execute(sql).fetchall()))
+        self.stale = False
+
+
+    def check(self, curs, station_id, modified):
+        """
+        Returns None if a message for station_id with the given timestamp
+        is newer than the station's market, or else the reason it isn't.
+        """
+        if self.stale:
+            self.warm(curs)
+        latest = self.modified.get(station_id)
+        if latest is None:
+            latest = curs.execute(self.latestStmt, (station_id,)).fetchone()[0]
+            if latest is None:
+                # No market at all yet.
+                return None
+            self.record(station_id, latest)
+        else:
+            self.modified.move_to_end(station_id)
+        if modified < latest:
+            reason = "older"
+        elif modified == latest:
+            reason = "same age"
+        else:
+            return None
+        self.rejected[reason] += 1
+        return reason
+
+
+    def record(self, station_id, modified):
+        """
+        Notes that station_id's market was written with the given timestamp.
+        """
+        self.modified[station_id] = modified
+        self.modified.move_to_end(station_id)
+        if self.maxSize and len(self.modified) > self.maxSize:
+            self.modified.popitem(last = False)
+
+
+    def counters(self):
+        return "Stale messages rejected: " + (", ".join(str(count) + " " + reason\
+               for reason, count in sorted(self.rejected.items())) or "none") + "."
+
+class SnapshotCache(object):
+    """
+    Remembers a hash of the market each station was last written with, so
+    that a message with an identical market, such as a re-send, only needs
+    the timestamps updating rather than every StationItem row comparing.
+
+    It holds up to maxSize stations, dropping the least recently used ones
+    when full, 0 meaning no limit. Call clear() whenever the database is
+    updated by something other than the message processor.
+
+    Attributes:
+        digests             OrderedDict of station_id => hash of its market,
+        hits                Number of messages found to be identical,
+        misses              Number of messages that weren't.
+    """
+
+    def __init__(self, maxSize=0):
+        self.maxSize = maxSize
+        self.digests = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def clear(self):
+        self.digests.clear()
+
+
+    @staticmethod
+    def digest(itemList, avgList):
+        """
+        Returns the hash of a station's market, ignoring the timestamp.
+        """
+        h = hashlib.blake2b(digest_size = 16)
+        for item, avg in zip(itemList, avgList):
+            h.update(repr((item[1],) + item[3:] + avg[:1]).encode())
+        return h.digest()
+
+
+    def matches(self, station_id, digest):
+        """
+        Returns True if digest is the hash the station was last written with.
+        """
+        if self.digests.get(station_id) == digest:
+            self.digests.move_to_end(station_id)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+
+    def record(self, station_id, digest):
+        self.digests[station_id] = digest
+        self.digests.move_to_end(station_id)
+        if self.maxSize and len(self.digests) > self.maxSize:
+            self.digests.popitem(last = False)
+
+
+    def counters(self):
+        total = self.hits + self.misses
+        return "Identical markets: " + str(self.hits) + " of " + str(total)\
+             + " (" + str(int(self.hits * 1000 / total) / 10 if total else 0) + "%)."
+
+def write_station_items(curs, station_id, modified, itemList):
+    """
+    Brings the StationItem rows for station_id in line with itemList,
+    writing only the rows that actually need it rather than deleting
+    and re-inserting the whole station.
+    Returns a RowCounts.
+    """
+    current = {}
+    for row in curs.execute(selStmt, (station_id,)):
+        current[row[0]] = row[1:]
+
+    insList = []
+    chgList = []
+    touchList = []
+    seen = set()
+    unchanged = 0
+    for item in itemList:
+        item_id = item[1]
+        # INSERT OR IGNORE used to keep the first of any duplicates, so do the same.
+        if item_id in seen:
+            continue
+        seen.add(item_id)
+        old = current.get(item_id)
+        if old is None:
+            insList.append(item)
+        elif old[:6] != item[3:]:
+            chgList.append((modified,) + item[3:] + (station_id, item_id))
+        elif old[6] != modified or old[7] != 1:
+            touchList.append((modified, station_id, item_id))
+        else:
+            unchanged += 1
+    delList = [(station_id, item_id) for item_id in current if item_id not in seen]
+
+    if delList:
+        curs.executemany(delStmt, delList)
+    if chgList:
+        curs.executemany(chgStmt, chgList)
+    if touchList:
+        curs.executemany(touchStmt, touchList)
+    if insList:
+        curs.executemany(insStmt, insList)
+
+    return RowCounts(len(insList), len(chgList), len(touchList), len(delList), unchanged)
+
+class AvgPriceCache(object):
+    """
+    Write-behind cache of the items' average prices. Nearly every market
+    message has the average price of every item it lists, and they hardly
+    ever change, so rather than updating Item for each message, the latest
+    price of each item is kept here, and only the ones that have changed
+    are written, all at once, every interval seconds.
+
+    Attributes:
+        pending             item_id => latest average price, not yet written,
+        written             item_id => average price last written,
+        flushTime           When the pending prices are next due to be written.
+    """
+
+    # Each item takes three SQL variables, and older versions of
+    # SQLite only allow 999 in one statement.
+    chunkSize = 300
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}
+        self.written = {}
+        self.flushTime = time.time() + interval
+
+
+    def invalidate(self):
+        """
+        Forgets what was written, for when something else has updated Item.
+        """
+        self.written.clear()
+
+
+    def update(self, avgList):
+        """
+        Records the average prices from a ResolvedMessage's avgList.
+        """
+        for avg_price, item_id in avgList:
+            if self.written.get(item_id) != avg_price:
+                self.pending[item_id] = avg_price
+            else:
+                self.pending.pop(item_id, None)
+
+
+    def due(self):
+        return self.pending and time.time() >= self.flushTime
+
+
+    def flush(self, curs):
+        """
+        Writes the pending prices using the given cursor, a chunk of items at
+        a time. The caller is responsible for the surrounding transaction.
+        Returns the number of items written.
+        """
+        prices = list(self.pending.items())
+        for i in range(0, len(prices), self.chunkSize):
+            chunk = prices[i:i + self.chunkSize]
+            curs.execute("UPDATE Item SET avg_price = CASE item_id" + " WHEN ? THEN ?" * len(chunk)\
+                         + " END WHERE item_id IN (" + ",".join("?" * len(chunk)) + ")",
+                         [value for price in chunk for value in price] + [item_id for item_id, avg_price in chunk])
+        self.written.update(self.pending)
+        self.pending.clear()
+        self.flushTime = time.time() + self.interval
+        return len(prices)
+
+class ResolvedMessage(namedtuple('ResolvedMessage', [
+        'station_id',
+        'system_id',
+        'name',
+        'modified',
+        'itemList',
+        'avgList',
+        'digest',
+        ])):
+    """
+    A market message turned into what's needed to write it to the database:
+    station_id      the station's id,
+    system_id       the id of the system a megaship is now in, or None,
+    name            "SYSTEM/STATION", for messages,
+    modified        the message's timestamp, as stored in StationItem,
+    itemList        the StationItem rows, ready to insert,
+    avgList         the (avg_price, item_id) Item updates,
+    digest          the SnapshotCache hash of the market.
+    """
+
+class UnknownCache(object):
+    """
+    Keeps track of the stations and items that aren't in the lookup tables,
+    so they aren't looked up, and reported, again for every message.
+
+    A station or item is remembered for ttl seconds, up to maxNames of them.
+    Messages for unknown stations are parked, keeping the newest for each
+    station, up to maxParked of them, and are put back in the queue when the
+    lookup tables are replaced, in case they know the station by then.
+    Rather than reporting each one, how many messages had unknown stations
+    or items, with a few examples, is reported every reportInterval seconds,
+    when verbose is on.
+
+    Attributes:
+        names               (kind, name) => when it stops being remembered,
+                            where kind is 'station', 'item' for items that
+                            are ignored, or 'placeholder' for items EDDB.io
+                            doesn't know, which are stored under their fdev_id,
+        parked              (system, station) => the newest MarketPrice,
+        counts              kind => number of messages since the last report,
+        examples            kind => set of names since the last report,
+        dropped             Number of parked messages dropped for lack of room,
+        version             Version of the IdResolver the stations and items
+                            are unknown to.
+    """
+
+    maxNames = 10000
+    reportInterval = 60.     # seconds
+    kinds = (('station', "messages for unknown stations"),
+             ('item', "messages with unknown items, which were ignored"),
+             ('placeholder', "messages with items EDDB.io's API does not include, using fdev_id as placeholder"))
+
+    def __init__(self, ttl, maxParked):
+        self.ttl = ttl
+        self.maxParked = maxParked
+        self.lock = threading.Lock()
+        self.names = OrderedDict()
+        self.parked = OrderedDict()
+        self.counts = defaultdict(int)
+        self.examples = defaultdict(set)
+        self.dropped = 0
+        self.version = 0
+        self.lastReport = time.time()
+
+
+    def remember(self, kind, name, now, count=1):
+        """
+        Must be called with the lock held.
+        """
+        self.counts[kind] += count
+        if len(self.examples[kind]) < 5:
+            self.examples[kind].add(name)
+        if (kind, name) not in self.names:
+            self.names[(kind, name)] = now + self.ttl
+            if len(self.names) > self.maxNames:
+                self.names.popitem(last = False)
+
+
+    def known(self, kind, name, now):
+        """
+        Returns whether name is remembered as unknown.
+        Must be called with the lock held.
+        """
+        expires = self.names.get((kind, name))
+        if expires is None:
+            return False
+        if expires <= now:
+            del self.names[(kind, name)]
+            return False
+        return True
+
+
+    def filter(self, batch):
+        """
+        Parks the messages in batch for stations already known to be unknown.
+        Returns the rest.
+        """
+        now = time.time()
+        with self.lock:
+            if not self.names:
+                return batch
+            remaining = []
+            for entry in batch:
+                if self.known('station', entry.system + "/" + entry.station, now):
+                    self.counts['station'] += 1
+                    self.park_entry(entry)
+                else:
+                    remaining.append(entry)
+            return remaining
+
+
+    def park_entry(self, entry):
+        """
+        Must be called with the lock held.
+        """
+        key = (entry.system, entry.station)
+        old = self.parked.get(key)
+        if old and old.timestamp > entry.timestamp:
+            return
+        self.parked[key] = entry
+        if len(self.parked) > self.maxParked:
+            self.parked.popitem(last = False)
+            self.dropped += 1
+
+
+    def add(self, unknown, items, version):
+        """
+        Remembers the messages with unknown stations, which are parked, and
+        the unknown items, as (kind, name) => number of messages, from
+        resolve_messages() using
+        the given version of the IdResolver. If the lookup tables have been
+        replaced since, nothing is remembered, and the messages are returned
+        so they can be tried again.
+        """
+        now = time.time()
+        with self.lock:
+            if version < self.version:
+                return unknown
+            for entry in unknown:
+                self.remember('station', entry.system + "/" + entry.station, now)
+                self.park_entry(entry)
+            for (kind, name), count in items.items():
+                self.remember(kind, name, now, count)
+        return []
+
+
+    def release(self, version):
+        """
+        Forgets everything, since the lookup tables have been replaced by the
+        given version, and returns the parked messages, so they can be tried
+        again.
+        """
+        with self.lock:
+            parked = list(self.parked.values())
+            self.parked.clear()
+            self.names.clear()
+            self.version = version
+        return parked
+
+
+    def report(self):
+        now = time.time()
+        if not config['verbose'] or now < self.lastReport + self.reportInterval:
+            return
+        with self.lock:
+            self.lastReport = now
+            if not self.counts:
+                return
+            log.info("In the last " + str(int(self.reportInterval)) + " seconds: " + ", ".join(
+                str(self.counts[kind]) + " " + description + " (" + ", ".join(sorted(self.examples[kind]))\
+                + (", ..." if len(self.examples[kind]) >= 5 else "") + ")"
+                for kind, description in self.kinds if self.counts[kind]) + ". "\
+                + str(len(self.parked)) + " messages parked, " + str(self.dropped) + " dropped.")
+            self.counts.clear()
+            self.examples.clear()
+
+def resolve_message(entry, res, items):
+    """
+    Looks up the ids for a single market message with the IdResolver res,
+    and builds the rows to write. Doesn't touch the database, so it can be
+    run anywhere, including in another process. Any items that aren't known
+    are added to the set items, as (kind, name) for the UnknownCache.
+    Returns a ResolvedMessage, or None if the station isn't known.
+    """
+    # Get the station_is using the system and station names.
+    system = entry.system.upper()
+    station = entry.station.upper()
+    # And the software version used to upload the schema.
+    software = entry.software
+    swVersion = entry.version
+
+    modified = entry.timestamp.replace('T',' ').replace('Z','')
+
+    station_id = res.station_ids.get(system + "/" + station)
+    system_id = None
+    if not station_id:
+        # Mobile stations are stored in the dict a bit differently.
+        station_id = res.station_ids.get("MEGASHIP/" + station)
+        system_id = res.system_ids.get(system)
+        if not station_id or not system_id:
+            return None
+
+    if config['debug']:
+        market_log.debug(system + "/" + station + " with station_id '" + str(station_id) + "' updated at " + modified + " using " + software + swVersion + " ---")
+
+    itemList = []
+    avgList = []
+    for name, sellPrice, demandUnits, demandLevel, buyPrice, stockUnits, stockLevel, meanPrice in entry.rows():
+        # Get fdev_id using commodity name from message.
+        item_edid = res.db_name.get(name)
+        if not item_edid:
+            # Ignoring rare item.
+            items.add(('item', name))
+            continue
+        # Some items, mostly recently added items, are found in db_name but not in item_ids
+        # (This is entirely EDDB.io's fault.)
+        item_id = res.item_ids.get(item_edid)
+        if not item_id:
+            items.add(('placeholder', name))
+            item_id = item_edid
+
+        itemList.append((
+            station_id, item_id, modified,
+            sellPrice, demandUnits, demandLevel,
+            buyPrice, stockUnits, stockLevel,
+        ))
+        # We only "need" to update the avg_price for the few items not included in
+        # EDDB.io's API, but might as well do it for all of them.
+        avgList.append((meanPrice, item_id))
+
+    return ResolvedMessage(station_id, system_id, system + "/" + station, modified,
+                           itemList, avgList, SnapshotCache.digest(itemList, avgList))
+
+# The IdResolver a resolve pool worker process was started with.
+worker_resolver = None
+
+def resolve_messages(entries, res=None):
+    """
+    Resolves a list of market messages, with the IdResolver res, or if not
+    given, the one a resolve pool worker process was started with.
+    Returns the list of ResolvedMessages, the list of messages for unknown
+    stations, a dictionary of (kind, name) => number of messages for the
+    unknown items, and the number of seconds it took.
+    """
+    start = time.time()
+    res = res or worker_resolver
+    resolved = []
+    unknown = []
+    items = defaultdict(int)
+    for entry in entries:
+        missing = set()
+        try:
+            msg = resolve_message(entry, res, missing)
+        except Exception as e:
+            market_log.error("Market update for " + entry.system.upper() + "/" + entry.station.upper()\
+                             + " failed and was skipped: " + str(e))
+            continue
+        if msg:
+            resolved.append(msg)
+        else:
+            unknown.append(entry)
+        for item in missing:
+            items[item] += 1
+    return resolved, unknown, dict(items), time.time() - start
+
+def init_resolve_worker(worker_config, worker_log_queue, res):
+    """
+    Sets up a resolve pool worker process with what resolve_message() needs,
+    since (depending on the platform) it may not have inherited any of it.
+    Its log records are sent back to the listener through worker_log_queue.
+    """
+    global config, worker_resolver
+    config = worker_config
+    setup_log_handler(worker_log_queue, local = False)
+    worker_resolver = res
+
+def apply_message(curs, msg, fresh=None, snapshots=None, avg_prices=None):
+    """
+    Writes a single ResolvedMessage to the database using the given cursor.
+    If fresh is given, the message is skipped unless it is newer than the
+    station's market. If snapshots is given, a message with the same market
+    as the station was last written with only has its timestamps updated.
+    If avg_prices is given, the average prices are left for it to write.
+    The caller is responsible for the surrounding transaction.
+    Returns the station_id and "SYSTEM/STATION" name of the updated station
+    and the RowCounts of the write, or None if the message was skipped.
+    """
+    station_id = msg.station_id
+    modified = msg.modified
+
+    # Don't let a late message overwrite newer data.
+    if fresh:
+        stale = fresh.check(curs, station_id, modified)
+        if stale:
+            if config['verbose']:
+                market_log.info("Skipping market update for " + msg.name\
+                                + ", not newer than the station's market (" + stale + ").")
+            return None
+
+    if msg.system_id:
+        market_log.info("Megaship station " + msg.name + ", updating system.")
+        # Update the system the station is in, in case it has changed.
+        curs.execute(updStmt, (msg.system_id, station_id))
+
+    try:
+        if snapshots and snapshots.matches(station_id, msg.digest):
+            # The rows and average prices are already what the message says.
+            curs.execute(touchStationStmt, (modified, station_id))
+            counts = RowCounts(0, 0, curs.rowcount, 0, 0)
+        else:
+            counts = write_station_items(curs, station_id, modified, msg.itemList)
+            if avg_prices:
+                avg_prices.update(msg.avgList)
+            else:
+                curs.executemany(avgStmt, msg.avgList)
+    except Exception as e:
+        if config['debug']:
+            market_log.debug("Error '" + str(e) + "' when inserting message:\n" + str(msg.itemList))
+        raise
+
+    if fresh:
+        fresh.record(station_id, modified)
+    if snapshots:
+        snapshots.record(station_id, msg.digest)
+    return station_id, msg.name, counts
+
+def write_batch(conn, batch, fresh=None, snapshots=None, avg_prices=None):
+    """
+    Writes a batch of ResolvedMessages to the database in a single transaction.
+    Messages that aren't newer than the station's market are skipped if the
+    StationFreshness fresh is given, and identical markets are only touched
+    if the SnapshotCache snapshots is. If the AvgPriceCache avg_prices is
+    given, the average prices are left to it, and it's flushed along with
+    the batch when it's due.
+    Returns a list of (station_id, "SYSTEM/STATION", RowCounts, seconds taken)
+    for each station that was updated.
+    """
+    curs = conn.cursor()
+
+    # The whole batch is written in a single transaction, so there's
+    # only one commit (and one fsync) no matter how many messages are in it.
+    success = False
+    locked = None
+    while not success:
+        try:
+            curs.execute("BEGIN IMMEDIATE")
+            success = True
+        except sqlite3.OperationalError:
+            log.info("Database is locked, waiting for access.")
+            metrics.inc('db_locked_total')
+            locked = locked or time.time()
+            time.sleep(1)
+    if locked:
+        metrics.observe('lock_wait', time.time() - locked)
+
+    start = time.time()
+    updated = []
+    for msg in batch:
+        start_update = datetime.datetime.now()
+        # Each message gets its own savepoint, so that a bad message
+        # can be rolled back without losing the rest of the batch.
+        curs.execute("SAVEPOINT message")
+        try:
+            result = apply_message(curs, msg, fresh, snapshots, avg_prices)
+            curs.execute("RELEASE SAVEPOINT message")
+        except Exception as e:
+            curs.execute("ROLLBACK TO SAVEPOINT message")
+            curs.execute("RELEASE SAVEPOINT message")
+            market_log.error("Market update for " + msg.name + " failed and was skipped: " + str(e))
+            continue
+        if result:
+            updated.append(result + ((datetime.datetime.now() - start_update).total_seconds(),))
+
+    if avg_prices and avg_prices.due():
+        flush_avg_prices(curs, avg_prices)
+    if batch:
+        metrics.observe('write', time.time() - start)
+
+    success = False
+    locked = None
+    while not success:
+        start = time.time()
+        try:
+            conn.commit()
+            success = True
+        except sqlite3.OperationalError:
+            log.info("Database is locked, waiting for access.")
+            metrics.inc('db_locked_total')
+            locked = locked or start
+            time.sleep(1)
+    metrics.observe('commit', time.time() - start)
+    if locked:
+        metrics.observe('lock_wait', start - locked)
+
+    return updated
+
+def flush_avg_prices(curs, avg_prices):
+    """
+    Writes the AvgPriceCache's pending prices, rolling back just them if
+    that fails, so the rest of the transaction can still be committed.
+    """
+    curs.execute("SAVEPOINT avg_prices")
+    try:
+        written = avg_prices.flush(curs)
+        curs.execute("RELEASE SAVEPOINT avg_prices")
+    except sqlite3.Error as e:
+        curs.execute("ROLLBACK TO SAVEPOINT avg_prices")
+        curs.execute("RELEASE SAVEPOINT avg_prices")
+        log.error("Unable to update average prices: " + str(e))
+        return
+    if config['debug']:
+        log.info("Updated the average prices of " + str(written) + " items.")
+
+def checkpoint_wal(conn):
+    """
+    Copies the changes in the WAL back into the database file, as far as it
+    can without waiting on any readers, such as the listings exporter.
+    """
+    try:
+        busy, pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    except sqlite3.OperationalError as e:
+        log.error("Unable to checkpoint WAL: " + str(e))
+        return
+    if config['debug']:
+        log.info("WAL checkpoint: " + str(checkpointed) + " of " + str(pages) + " pages checkpointed.")
+
+def checkpoint_if_due(db, checkpoint_time):
+    """
+    Checkpoints the WAL using the DBConnection db if checkpoint_time has
+    passed. Must be called outside of any transaction.
+    Returns the time the next checkpoint is due.
+    """
+    if not use_wal or time.time() < checkpoint_time:
+        return checkpoint_time
+    with db_access.shared():
+        checkpoint_wal(db.get())
+    return time.time() + config['wal_checkpoint_every_x_sec']
+
+def setup_writer(conn):
+    if use_wal:
+        # Keep the WAL file from staying huge after a burst of writes.
+        conn.execute("PRAGMA journal_size_limit = 67108864")
+
+class StageTimer(object):
+    """
+    Keeps track of how much of the time a stage of the message pipeline
+    spends working, rather than waiting for messages or for the next stage.
+    workers is how many threads or processes the stage has, so that the
+    work they do at the same time can be shown as a fraction of what they
+    could do.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.since = time.time()
+
+
+    def add(self, seconds):
+        with self.lock:
+            self.busy += seconds
+
+
+    def take(self):
+        """
+        Returns the percentage of the time since the last call that the
+        stage was busy.
+        """
+        with self.lock:
+            now = time.time()
+            busy = self.busy / (self.workers * max(now - self.since, 0.001))
+            self.busy = 0
+            self.since = now
+        return str(int(min(busy, 1) * 1000) / 10) + "%"
+
+class Metrics(object):
+    """
+    Counters, and latency histograms for each stage of the message pipeline,
+    for the metrics endpoint and the summary line. Thread-safe.
+
+    Names are given without the "eddblink_" prefix, which render() adds.
+    Values kept elsewhere, such as the queue's counters, are read through
+    the functions given to register() when they're needed.
+
+    Every process has its own Metrics. Worker processes send theirs back
+    to the listener with take(), for it to merge().
+    """
+    prefix = "eddblink_"
+    # Upper bounds of the histogram buckets, in seconds.
+    buckets = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+    stages = OrderedDict([
+        ('receive', "reading a burst of messages from the EDDN"),
+        ('parse', "decompressing and parsing a message"),
+        ('filter', "checking a message against the whitelist"),
+        ('queue_wait', "a message waiting in the queue"),
+        ('resolve', "resolving a batch of messages"),
+        ('write', "writing a batch of messages to the database"),
+        ('commit', "committing a batch of messages"),
+        ('lock_wait', "waiting for a locked database"),
+        ('access_wait', "waiting for access to the database from the other threads"),
+        ('export', "exporting the listings"),
+    ])
+    counterHelp = OrderedDict([
+        ('messages_received_total', "Messages received from the EDDN."),
+        ('messages_rejected_total', "Messages rejected by the listener, by reason."),
+        ('messages_dropped_total', "Messages dropped by the listener before being decoded, by reason."),
+        ('messages_written_total', "Market updates written to the database."),
+        ('db_locked_total', "Times the database was found locked."),
+        ('exports_total', "Listings exports, by type."),
+    ])
+
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) => value
+        self.counters = OrderedDict()
+        # stage => number of observations in each bucket, the last for
+        # anything above the largest bucket.
+        self.counts = OrderedDict((stage, [0] * (len(self.buckets) + 1)) for stage in self.stages)
+        self.sums = dict.fromkeys(self.stages, 0.)
+        # The counts at the last summary.
+        self.lastCounts = {stage: list(counts) for stage, counts in self.counts.items()}
+        # name => (type, help, function)
+        self.callbacks = OrderedDict()
+
+
+    def inc(self, name, count=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + count
+
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.counts[stage][bisect.bisect_left(self.buckets, seconds)] += 1
+            self.sums[stage] += seconds
+
+
+    def register(self, name, kind, help, function):
+        """
+        Adds a value of type kind, 'counter' or 'gauge', that is read by
+        calling function.
+        """
+        self.callbacks[name] = (kind, help, function)
+
+
+    def take(self):
+        """
+        Returns the counters and histograms, for merge(), and clears them.
+        """
+        with self.lock:
+            taken = (self.counters, self.counts, self.sums)
+            self.counters = OrderedDict()
+            self.counts = OrderedDict((stage, [0] * (len(self.buckets) + 1)) for stage in self.stages)
+            self.sums = dict.fromkeys(self.stages, 0.)
+        return taken
+
+
+    def merge(self, taken):
+        counters, counts, sums = taken
+        with self.lock:
+            for key, count in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + count
+            for stage, stageCounts in counts.items():
+                self.counts[stage] = [a + b for a, b in zip(self.counts[stage], stageCounts)]
+                self.sums[stage] += sums[stage]
+
+
+    @staticmethod
+    def labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                              for name, value in labels) + "}"
+
+
+    def render(self):
+        """
+        Returns everything in the Prometheus text exposition format.
+        """
+        values = [(name, kind, help, function()) for name, (kind, help, function) in self.callbacks.items()]
+        lines = []
+        with self.lock:
+            for name, help in self.counterHelp.items():
+                samples = [(labels, value) for (key, labels), value in self.counters.items() if key == name]
+                if not samples:
+                    continue
+                lines.append("# HELP " + self.prefix + name + " " + help)
+                lines.append("# TYPE " + self.prefix + name + " counter")
+                for labels, value in samples:
+                    lines.append(self.prefix + name + self.labels(labels) + " " + str(value))
+
+            name = self.prefix + "stage_seconds"
+            lines.append("# HELP " + name + " Time taken by each stage of the message pipeline.")
+            lines.append("# TYPE " + name + " histogram")
+            for stage, counts in self.counts.items():
+                total = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    total += count
+                    lines.append(name + "_bucket" + self.labels((('stage', stage), ('le', bound))) + " " + str(total))
+                lines.append(name + "_sum" + self.labels((('stage', stage),)) + " " + str(self.sums[stage]))
+                lines.append(name + "_count" + self.labels((('stage', stage),)) + " " + str(total))
+
+        for name, kind, help, value in values:
+            lines.append("# HELP " + self.prefix + name + " " + help)
+            lines.append("# TYPE " + self.prefix + name + " " + kind)
+            lines.append(self.prefix + name + " " + str(value))
+        return "\n".join(lines) + "\n"
+
+
+    def summary(self):
+        """
+        Returns a line with the median and 95th percentile of each stage
+        since the last summary, (as the bucket they fall in,) and the
+        current value of everything registered.
+        """
+        def bound(counts, fraction):
+            target = sum(counts) * fraction
+            total = 0
+            for index, count in enumerate(counts):
+                total += count
+                if total >= target:
+                    break
+            if index == len(self.buckets):
+                return ">" + str(self.buckets[-1]) + "s"
+            if self.buckets[index] < 1:
+                return str(self.buckets[index] * 1000) + "ms"
+            return str(self.buckets[index]) + "s"
+
+        stages = []
+        with self.lock:
+            for stage, counts in self.counts.items():
+                delta = [a - b for a, b in zip(counts, self.lastCounts[stage])]
+                self.lastCounts[stage] = list(counts)
+                if sum(delta):
+                    stages.append(stage + " " + str(sum(delta)) + "x " + bound(delta, .5) + "/" + bound(delta, .95))
+        values = [name + " " + str(function()) for name, (kind, help, function) in self.callbacks.items()]
+        return "Metrics: " + (", ".join(stages) or "nothing") + " (count, median/95th percentile). " + ", ".join(values) + "."
+
+# The metrics of this process.
+metrics = Metrics()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the metrics at /metrics, in the Prometheus text format.
+    """
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        if config['debug']:
+            log.debug("Metrics request from " + self.address_string() + ": " + format % args)
+
+def start_metrics_server(port):
+    """
+    Starts serving the metrics on localhost at the given port, in a thread of
+    its own. Returns the server, or None if it couldn't be started.
+    """
+    try:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    except OSError as e:
+        log.error("Unable to serve metrics on port " + str(port) + ": " + str(e))
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Metrics server", daemon=True).start()
+    log.info("Serving metrics at http://127.0.0.1:" + str(port) + "/metrics")
+    return server
+
+def resolve_batches():
+    """
+    The resolve stage of the message pipeline: takes batches of messages off
+    the queue, turns them into ResolvedMessages, and hands them to the
+    message processor to write. With more than one worker, or the 'process'
+    pool, each batch is split between the workers of a thread or process
+    pool. A process pool is restarted with the new lookup tables whenever
+    they're replaced.
+    """
+    workers = config['resolve_workers']
+    pool = None
+    pool_version = None
+    try:
+        while go:
+            # Get a batch of up to "batch_max_messages" messages from the queue,
+            # waiting no longer than "batch_max_ms" milliseconds after the first
+            # message for the rest of the batch to fill up.
+            batch = q.get_many(config['batch_max_messages'], config['batch_max_ms'] / 1000, 1)
+            unknowns.report()
+            received = len(batch)
+            # Messages for stations already known to be unknown are parked
+            # without trying to resolve them again.
+            batch = unknowns.filter(batch)
+            if not batch:
+                continue
+
+            start = time.time()
+            # Use the same lookup tables for the whole batch, even if
+            # they're replaced part way through.
+            res = resolver
+            if config['resolve_pool'] == 'thread' and workers == 1:
+                resolved, unknown, items, work = resolve_messages(batch, res)
             else:
-                valid = False
-        if not valid:
-            if valid_options.find("force") == -1:
-                valid_options = "force," + valid_options 
-            if valid_options.find("skipvend") == -1:
-                valid_options = "skipvend," + valid_options 
-            if valid_options.find("all") == -1:
-                valid_options = "all," + valid_options 
-            config_file = config_file.replace(config['plugin_options'],valid_options)
-    else:
-        valid = False
-        config_file = config_file.replace('"plugin_options"','"plugin_options_invalid"')
-        
-    if isinstance(config['check_update_every_x_sec'], int):
-        if config['check_update_every_x_sec'] < 1:
-            valid = False
-            config_file = config_file.replace('"check_update_every_x_sec"','"check_update_every_x_sec_invalid"')
-    else:
-        valid = False
-        config_file = config_file.replace('"check_update_every_x_sec"','"check_update_every_x_sec_invalid"')
-        
-    if isinstance(config['export_every_x_sec'], int):
-        if config['export_every_x_sec'] < 1:
-            valid = False
-            config_file = config_file.replace('"export_every_x_sec"','"export_every_x_sec_invalid"')
-    else:
-        valid = False
-        config_file = config_file.replace('"export_every_x_sec"','"export_every_x_sec_invalid"')
-    
-    if isinstance(config['server_maint_every_x_hour'], (int,float)):
-        if config['server_maint_every_x_hour'] < 1 or config['server_maint_every_x_hour'] > 24:
-            valid = False
-            config_file = config_file.replace('"server_maint_every_x_hour"','"server_maint_every_x_hour_invalid"')
-    else:
-        valid = False
-        config_file = config_file.replace('"server_maint_every_x_hour"','"server_maint_every_x_hour_invalid"')
-    
-    if not Path.exists(Path(config['export_path'])):
-        valid = False
-        config_file = config_file.replace('"export_path"','"export_path_invalid"')
-    
-    # Here, we get rid of 'eddi' in existing configs.
-    for entry in config['whitelist']:
-        if entry['software'].lower() == 'eddi':
-            config_file = config_file.replace(',\n        {\n            "software": "eddi",\n            "minversion": "2.2"\n        }','')
-            valid = False
-            
-    if not valid:
-        # Before we reload the config to set the invalid values back to default,
-        # we need to write the changes we made to the file.
-        with open("eddblink-listener-config.json", "w") as fh:
-            fh.write(config_file)
-        config = load_config()
-    
+                try:
+                    if config['resolve_pool'] == 'process' and pool_version != res.version:
+                        if pool:
+                            pool.shutdown()
+                        # Spawned rather than forked, since forking a process
+                        # with other threads running isn't safe.
+                        pool = concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'),
+                                                                      init_resolve_worker, (config, worker_log_queue, res))
+                        pool_version = res.version
+                    elif not pool:
+                        pool = concurrent.futures.ThreadPoolExecutor(workers, "Message resolver")
+                    size = -(-len(batch) // workers)
+                    chunks = [batch[i:i + size] for i in range(0, len(batch), size)]
+                    if config['resolve_pool'] == 'process':
+                        results = pool.map(resolve_messages, chunks)
+                    else:
+                        results = pool.map(resolve_messages, chunks, [res] * len(chunks))
+                    resolved = []
+                    unknown = []
+                    items = defaultdict(int)
+                    work = 0
+                    for chunk, chunkUnknown, chunkItems, seconds in results:
+                        resolved.extend(chunk)
+                        unknown.extend(chunkUnknown)
+                        for item, count in chunkItems.items():
+                            items[item] += count
+                        work += seconds
+                except Exception as e:
+                    # Don't let a broken pool stop the pipeline: resolve the
+                    # batch here, and start a new pool for the next one.
+                    log.error("Resolve workers failed, resolving the batch without them: " + repr(e))
+                    if pool:
+                        pool.shutdown(wait = False)
+                    pool = None
+                    pool_version = None
+                    resolved, unknown, items, work = resolve_messages(batch, res)
+            # If the lookup tables were replaced while the batch was being
+            # resolved, the unknown stations might be known now.
+            for entry in unknowns.add(unknown, items, res.version):
+                q.put(entry)
+            resolve_timer.add(time.time() - start)
+            metrics.observe('resolve', time.time() - start)
+            worker_timer.add(work)
+
+            resolved_q.put((received, resolved))
+    finally:
+        if pool:
+            pool.shutdown()
+        # Let the message processor know there's nothing more coming.
+        resolved_q.put(None)
+        log.info("Shutting down message resolver.")
 
 def process_messages():
-    global process_ack
-    tdb = tradedb.TradeDB(load=False)
-    conn = tdb.getDB()
-    # Place the database into autocommit mode to avoid issues with
+    """
+    The write stage of the message pipeline: writes the batches of messages
+    from the resolve stage to the database. This is the only thread that
+    writes market messages, since SQLite only allows one writer at a time.
+    Runs until the resolve stage has shut down.
+    """
+    # The connection is in autocommit mode to avoid issues with
     # sqlite3 doing automatic transactions.
-    conn.isolation_level = None
-    curs = conn.cursor()
+    db = DBConnection(setup_writer)
+    checkpoint_time = time.time() + config['wal_checkpoint_every_x_sec']
 
-    # same SQL every time
-    updStmt = "UPDATE Station SET system_id = ? WHERE station_id = ?"
-    delStmt = "DELETE FROM StationItem WHERE station_id = ?"
-    insStmt = (
-        "INSERT OR IGNORE INTO StationItem("
-        " station_id, item_id, modified,"
-        " demand_price, demand_units, demand_level,"
-        " supply_price, supply_units, supply_level, from_live)"
-        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)"
-    )
-    avgStmt = "UPDATE Item SET avg_price = ? WHERE item_id = ?"
+    while True:
+        try:
+            resolved = resolved_q.get(timeout = 1)
+        except queue.Empty:
+            # Nothing to write, so this is a good time to write the average
+            # prices, if they're due. (Otherwise they're written with the
+            # next batch.)
+            if avg_prices.due():
+                with db_access.shared():
+                    write_batch(db.get(), [], avg_prices = avg_prices)
+            checkpoint_time = checkpoint_if_due(db, checkpoint_time)
+            continue
+        if resolved is None:
+            break
+        received, batch = resolved
 
-    while go:
-        # We don't want the threads interfering with each other,
-        # so pause this one if either the update checker or
-        # listings exporter report that they're active.
-        if update_busy or export_busy:
-            print("Message processor acknowledging busy signal.")
-            process_ack = True
-            while (update_busy or export_busy) and go:
-                time.sleep(1)
-            process_ack = False
-            # Just in case we caught the shutdown command while waiting.
-            if not go:
+        start_batch = datetime.datetime.now()
+
+        # We don't want the threads interfering with each other, so this
+        # waits while the update checker or listings exporter have the database.
+        with db_access.shared():
+            start = time.time()
+            updated = write_batch(db.get(), batch, freshness, snapshots, avg_prices)
+            write_timer.add(time.time() - start)
+            # If a shadow import is running, the messages need writing to its
+            # copy too. This has to be done before letting go of the database,
+            # so the final replay before the swap can't miss the batch.
+            with journal_lock:
+                if shadow_journal is not None:
+                    shadow_journal.extend(batch)
+        metrics.inc('messages_written_total', len(updated))
+
+        if config['side'] == 'server':
+            # Let the listings exporter know which stations to put in the next delta.
+            with changes_lock:
+                changed_stations.update(result[0] for result in updated)
+
+        for station_id, name, counts, duration in updated:
+            if config['verbose']:
+                market_log.info("Market update for " + name\
+                                + " finished in " + str(int(duration * 1000) / 1000) + " seconds. (" + str(counts) + ")")
+            else:
+                market_log.info("Updated " + name)
+        if config['verbose'] and received > 1:
+            log.info("Committed batch of " + str(len(updated)) + " of " + str(received) + " market updates in "\
+                     + str(int((datetime.datetime.now() - start_batch).total_seconds() * 1000) / 1000) + " seconds. "\
+                     + q.counters() + " " + freshness.counters() + " " + snapshots.counters()\
+                     + " Busy: resolving " + resolve_timer.take() + " (workers " + worker_timer.take() + "),"\
+                     + " writing " + write_timer.take() + ".")
+
+        # A busy server may never go a whole second without a batch, so the
+        # WAL has to be checkpointed between batches too.
+        checkpoint_time = checkpoint_if_due(db, checkpoint_time)
+
+    # Don't lose the average prices that haven't been written yet.
+    if avg_prices.pending:
+        avg_prices.flushTime = 0
+        with db_access.shared():
+            write_batch(db.get(), [], avg_prices = avg_prices)
+    log.info("Shutting down message processor.")
+
+# The columns in the order they're written to the listings file, with
+# the modified timestamp converted to a Unix epoch by SQLite itself.
+listingsColumns = (
+    "SELECT station_id, item_id,"
+    " supply_units, supply_level, supply_price,"
+    " demand_price, demand_units, demand_level,"
+    " CAST(strftime('%s', modified) AS INTEGER)"
+    " FROM StationItem WHERE from_live = 1"
+)
+listingsStmt = listingsColumns + " ORDER BY station_id, item_id"
+
+def station_chunks(stations, size=500):
+    """
+    Splits stations into sorted chunks small enough to use as the
+    parameters of an "IN (?, ...)" clause.
+    """
+    stations = sorted(stations)
+    for i in range(0, len(stations), size):
+        yield stations[i:i + size]
+
+def in_clause(chunk):
+    return " AND station_id IN (" + ",".join("?" * len(chunk)) + ")"
+
+def write_listings(fh, cursors, arraysize=1000):
+    """
+    Streams the listings selected by each of cursors in turn (using
+    listingsColumns) into fh as csv, fetching arraysize rows at a time so
+    memory use stays flat no matter how many listings there are.
+    Returns the number of listings written, or None if the export was
+    aborted because of the shutdown signal.
+    """
+    writer = csv.writer(fh, lineterminator = "\n")
+    writer.writerow(("id","station_id","commodity_id","supply","supply_bracket","buy_price","sell_price","demand","demand_bracket","collected_at"))
+    lineNo = 0
+    for cursor in cursors:
+        while True:
+            results = cursor.fetchmany(arraysize)
+            if not results:
                 break
-            print("Busy signal off, message processor resuming.")
+            # If we lose go during export, we need to abort.
+            if not go:
+                return None
+            writer.writerows((lineNo + i,) + result for i, result in enumerate(results, 1))
+            lineNo += len(results)
+    return lineNo
 
-        # Either get the first message in the queue,
-        # or go to sleep and wait if there aren't any.
+def replace_file(tmp, dest):
+    """
+    Renames tmp to dest, waiting for dest to be deleted first if
+    something else has it open.
+    """
+    while dest.exists():
         try:
-            entry = q.popleft()
-        except IndexError:
+            dest.unlink()
+        except:
             time.sleep(1)
-            continue
+    tmp.rename(dest)
 
-        # Get the station_is using the system and station names.
-        system = entry.system.upper()
-        station = entry.station.upper()
-        # And the software version used to upload the schema.
-        software = entry.software
-        swVersion = entry.version
-
-        station_id = station_ids.get(system + "/" + station)
-        if not station_id:
-            # Mobile stations are stored in the dict a bit differently.
-            station_id = station_ids.get("MEGASHIP/" + station)
-            system_id = system_ids.get(system)
-            if station_id and system_id:
-                print("Megaship station, updating system.", end=" ")
-                # Update the system the station is in, in case it has changed.
-                success = False
-                while not success:
-                    try:
-                        curs.execute("BEGIN IMMEDIATE")
-                        curs.execute(updStmt, (system_id, station_id))
-                        conn.commit()
-                        success = True
-                    except sqlite3.OperationalError:
-                        print("Database is locked, waiting for access.", end = "\n")
-                        time.sleep(1)
-            else:
-                if config['verbose']:
-                    print("ERROR: Not found in Stations: " + system + "/" + station)
-                continue
+class HashingFile(object):
+    """
+    Binary file that keeps track of the size and SHA-256 of everything
+    written to it.
+    """
 
-        modified = entry.timestamp.replace('T',' ').replace('Z','')
-        commodities= entry.commodities
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(str(path), "wb", buffering = 1 << 20)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
 
-        start_update = datetime.datetime.now()
-        if config['debug']:
-            with debugPath.open('a', encoding = "utf-8") as fh:
-                fh.write(system + "/" + station + " with station_id '" + str(station_id) + "' updated at " + modified + " using " + software + swVersion + " ---\n")
-
-        itemList = []
-        avgList = []
-        for commodity in commodities:
-            if commodity['sellPrice'] == 0 and commodity['buyPrice'] == 0:
-                # Skip blank entries
-                continue
-            # Get fdev_id using commodity name from message.
-            item_edid = db_name.get(commodity['name'].lower())
-            if not item_edid:
-                if config['verbose']:
-                    print("Ignoring rare item: " + commodity['name'])
-                continue
-            # Some items, mostly recently added items, are found in db_name but not in item_ids
-            # (This is entirely EDDB.io's fault.)
-            item_id = item_ids.get(item_edid)
-            if not item_id:
-                if config['verbose']:
-                    print("EDDB.io's API does not include likely recently added item: '" + commodity['name'] + "', using fdev_id as placeholder, please inform the current EDDB.io maintainer.")
-                item_id = item_edid
-
-            itemList.append((
-                station_id, item_id, modified,
-                commodity['sellPrice'], commodity['demand'],
-                commodity['demandBracket'] if commodity['demandBracket'] != '' else -1,
-                commodity['buyPrice'], commodity['stock'],
-                commodity['stockBracket'] if commodity['stockBracket'] != '' else -1,
-            ))
-            # We only "need" to update the avg_price for the few items not included in
-            # EDDB.io's API, but might as well do it for all of them.
-            avgList.append((commodity['meanPrice'], item_id))
-
-        success = False
-        while not success:
-            try:
-                curs.execute("BEGIN IMMEDIATE")
-                success = True
-            except sqlite3.OperationalError:
-                print("Database is locked, waiting for access.", end = "\n")
-                time.sleep(1)
-        curs.execute(delStmt, (station_id,))
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fh.write(data)
+
+
+    def flush(self):
+        self.fh.flush()
+
+
+    def close(self):
+        self.fh.close()
+
+
+class ExportWriter(object):
+    """
+    Text file-like object that writes an export file, along with gzip and,
+    if the zstandard module is installed, zstd compressed copies of it, in
+    one pass. Everything is written to ".tmp" files until commit() is
+    called, which moves them all into place.
+
+    Attributes:
+        path                The export file,
+        generated           Unix epoch the export was generated at,
+        files               The files being written, as
+                            {format: (final path, HashingFile, stream)},
+                            where stream is what the data is written to.
+    """
+
+    def __init__(self, path, generated):
+        self.path = path
+        self.generated = generated
+        self.files = OrderedDict()
+        self.pending = []
+        self.pendingSize = 0
+
+        self.open_file('csv', path, None)
+        self.open_file('gzip', path.with_name(path.name + ".gz"),
+                       lambda fh: gzip.GzipFile(path.name, "wb", 6, fh, generated))
+        if zstandard:
+            self.open_file('zstd', path.with_name(path.name + ".zst"),
+                           lambda fh: zstandard.ZstdCompressor().stream_writer(fh))
+
+
+    def open_file(self, format, path, compressor):
+        fh = HashingFile(path.with_name(path.name + ".tmp"))
+        self.files[format] = (path, fh, compressor(fh) if compressor else fh)
+
+
+    def write(self, text):
+        # csv.writer writes one row at a time, so gather
+        # them up to avoid compressing tiny pieces.
+        self.pending.append(text)
+        self.pendingSize += len(text)
+        if self.pendingSize >= 1 << 16:
+            self.flush_pending()
+
+
+    def flush_pending(self):
+        data = "".join(self.pending).encode()
+        self.pending = []
+        self.pendingSize = 0
+        for path, fh, stream in self.files.values():
+            stream.write(data)
+
+
+    def close(self):
+        self.flush_pending()
+        for format, (path, fh, stream) in self.files.items():
+            if format == 'gzip':
+                stream.close()
+            elif format == 'zstd':
+                stream.flush(zstandard.FLUSH_FRAME)
+            fh.close()
+
+
+    def commit(self):
+        """
+        Moves the finished files into place, and returns the manifest
+        information for them.
+        """
+        self.close()
+        info = OrderedDict()
+        for format, (path, fh, stream) in self.files.items():
+            replace_file(fh.path, path)
+            info[format] = OrderedDict([
+                ('file', path.name),
+                ('size', fh.size),
+                ('sha256', fh.sha256.hexdigest()),
+            ])
+        return info
+
+
+    def abort(self):
+        """
+        Throws away the unfinished files.
+        """
+        self.close()
+        for path, fh, stream in self.files.values():
+            fh.path.unlink()
+
+def load_manifest(manifest_file):
+    """
+    Loads the listings manifest, which lists the current full listings
+    export and the delta exports made since then.
+    If there isn't one, returns a new, empty manifest.
+    """
+    if manifest_file.exists():
         try:
-            curs.executemany(insStmt, itemList)
-            curs.executemany(avgStmt, avgList)
-        except Exception as e:
-            if config['debug']:
-                with debugPath.open('a', encoding = "utf-8") as fh:
-                    fh.write("Error '" + str(e) + "' when inserting message:\n" + str(itemList))
-        success = False
-        while not success:
-            try:
-                conn.commit()
-                success = True
-            except sqlite3.OperationalError:
-                print("Database is locked, waiting for access.", end = "\n")
-                time.sleep(1)
-
-        if config['verbose']:
-            print("Market update for " + system + "/" + station\
-                  + " finished in " + str(int((datetime.datetime.now() - start_update).total_seconds() * 1000) / 1000) + " seconds.")
-        else:
-            print( "Updated " + system + "/" + station)
+            with manifest_file.open('r', encoding = "utf-8") as fh:
+                return json.load(fh, object_pairs_hook=OrderedDict)
+        except (OSError, ValueError) as e:
+            log.info("Unable to read listings manifest, starting a new one: " + str(e))
+    return OrderedDict([('sequence', 0), ('full', None), ('deltas', [])])
 
-    print("Shutting down message processor.")
+def save_manifest(manifest_file, manifest):
+    manifest_tmp = manifest_file.with_name(manifest_file.name + ".tmp")
+    with manifest_tmp.open('w', encoding = "utf-8") as fh:
+        json.dump(manifest, fh, indent = 4)
+    replace_file(manifest_tmp, manifest_file)
 
-def fetchIter(cursor, arraysize=1000):
+def peak_rss_mb():
     """
-    An iterator that uses fetchmany to keep memory usage down
-    and speed up the time to retrieve the results dramatically.
+    Returns the peak resident set size of this process, in MB.
     """
-    while True:
-        results = cursor.fetchmany(arraysize)
-        if not results:
-            break
-        for result in results:
-            yield result
-            
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports it in KB, OSX in bytes.
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak // 1024
+
 def export_listings():
     """
-    Creates a "listings-live.csv" file in "export_path" every X seconds,
+    Exports the live listings to "export_path" every X seconds,
     as defined in the configuration file.
+    Every "export_full_every_x_sec" seconds, or after an EDDB update,
+    this is a full export to "listings-live.csv". The rest of the time,
+    only the listings of the stations updated since the last export are
+    exported, to a sequence-numbered "listings-live-delta-########.csv".
+    Each export is also compressed with gzip, (and zstd, if the zstandard
+    module is installed,) as ".gz" and ".zst" files alongside it.
+    The manifest "listings-live.json" lists the current full export and
+    the deltas that apply to it, with the size and SHA-256 of each file.
     Only runs when program configured as server.
     """
-    global export_ack, export_busy
+    global changed_stations, full_export_due
 
     if config['side'] == 'server':
         # We want to perform some automatic DB maintenance when running as server.
         maintenance_time = time.time() + (config['server_maint_every_x_hour'] * 3600)
-        tdb = tradedb.TradeDB(load=False)
-        db = tdb.getDB()
-        listings_file = (Path(config['export_path']).resolve() / Path("listings-live.csv"))
-        listings_tmp = listings_file.with_suffix(".tmp")
-        print("Listings will be exported to: \n\t" + str(listings_file))
+        # The export's read transaction is managed by hand.
+        db = DBConnection()
+        export_dir = Path(config['export_path']).resolve()
+        listings_file = export_dir / Path("listings-live.csv")
+        manifest_file = export_dir / Path("listings-live.json")
+        manifest = load_manifest(manifest_file)
+        last_full = 0
+        log.info("Listings will be exported to: \n\t" + str(listings_file))
 
         while go:
             now = time.time()
             # Wait until the time specified in the "export_every_x_sec" config
-            # before doing an export, watch for busy signal or shutdown signal
+            # before doing an export, watch for maintenance time or shutdown signal
             # while waiting. 
             while time.time() < now + config['export_every_x_sec']:
                 if not go:
                     break
-                if update_busy:
-                    print("Listings exporter acknowledging busy signal.")
-                    export_ack = True
-                    while update_busy and go:
-                        time.sleep(1)
-                    export_ack = False
-                    # Just in case we caught the shutdown command while waiting.
-                    if not go:
-                        break
-                    print("Busy signal off, listings exporter resuming.")
-                    now = time.time()
                 if time.time() >= maintenance_time:
                     start = datetime.datetime.now()
-                    print("Performing server maintenance tasks." + str(start))
+                    log.info("Performing server maintenance tasks." + str(start))
                     try:
-                        db_execute(db, "VACUUM")
-                        db_execute(db, "PRAGMA optimize")
-                    except Error as e:
-                        print("Error performing maintenance: " + str(e) )
+                        with db_access.exclusive_access():
+                            conn = db.get()
+                            db_execute(conn, "VACUUM")
+                            db_execute(conn, "PRAGMA optimize")
+                    except sqlite3.Error as e:
+                        log.error("Unable to perform maintenance: " + str(e))
                     maintenance_time = time.time() + (config['server_maint_every_x_hour'] * 3600)
                     complete = datetime.datetime.now()
-                    print("Server maintenance tasks completed. " + str(complete))
-                    print("Maintenance cycle took " + str(complete - start) + ".")
-                time.sleep(1)
+                    log.info("Server maintenance tasks completed. " + str(complete))
+                    log.info("Maintenance cycle took " + str(complete - start) + ".")
+                with signals:
+                    if go:
+                        signals.wait(min(now + config['export_every_x_sec'], maintenance_time) - time.time())
             
             # We may be here because we broke out of the waiting loop,
             # so we need to see if we lost go and quit the main loop if so. 
@@ -774,75 +3613,236 @@ def export_listings():
 
             start = datetime.datetime.now()
 
-            print("Listings exporter sending busy signal. " + str(start))
-            export_busy = True
-            # We don't need to wait for acknowledgement from the update checker,
-            # because it waits for one from this, and this won't acknowledge
-            # until it's finished exporting.
-            while not (process_ack):
-                if not go:
-                    break
-            print("Busy signal acknowledged, getting listings for export.")
-            try:
-                results = list(fetchIter(db_execute(db, "SELECT * FROM StationItem WHERE from_live = 1 ORDER BY station_id, item_id")))
-            except sqlite3.DatabaseError as e:
-                print(e)
-                export_busy = False
+            # Take the stations the message processor has updated since the last
+            # export. Anything it commits from here on goes in the next export.
+            with changes_lock:
+                full = full_export_due or manifest['full'] is None\
+                       or time.time() >= last_full + config['export_full_every_x_sec']
+                stations = changed_stations
+                changed_stations = set()
+                full_export_due = False
+            if not (full or stations):
+                log.info("No listings updated since last export.")
                 continue
-            export_busy = False
-            
-            print("Exporting 'listings-live.csv'. (Got listings in " + str(datetime.datetime.now() - start) + ")")
-            with open(str(listings_tmp), "w") as f:
-                f.write("id,station_id,commodity_id,supply,supply_bracket,buy_price,sell_price,demand,demand_bracket,collected_at\n")
-                lineNo = 1
-                for result in results:
-                    # If we lose go during export, we need to abort.
-                    if not go:
-                        break
-                    station_id = str(result[0])
-                    commodity_id = str(result[1])
-                    sell_price = str(result[2])
-                    demand = str(result[3])
-                    demand_bracket = str(result[4])
-                    buy_price = str(result[5])
-                    supply = str(result[6])
-                    supply_bracket = str(result[7])
-                    collected_at = str(timegm(datetime.datetime.strptime(result[8],'%Y-%m-%d %H:%M:%S').timetuple()))
-                    listing = station_id + "," + commodity_id + ","\
-                             + supply + "," + supply_bracket + "," + buy_price + ","\
-                             + sell_price + "," + demand + "," + demand_bracket + ","\
-                             + collected_at
-                    f.write(str(lineNo) + "," + listing + "\n")
-                    lineNo += 1
-            del results
-            # If we aborted the export because we lost go, listings_tmp is broken and useless, so delete it. 
-            if not go:
-                listings_tmp.unlink()
-                print("Export aborted, received shutdown signal.")
+
+            sequence = manifest['sequence'] + 1
+            if full:
+                export_file = listings_file
+            else:
+                export_file = export_dir / Path("listings-live-delta-" + str(sequence).zfill(8) + ".csv")
+            generated = int(time.time())
+            out = None
+
+            # The database is in WAL mode, so the export works from a consistent
+            # snapshot of the database in its own read transaction while the
+            # message processor carries on writing. Shared access is only needed
+            # to keep the update checker and server maintenance out meanwhile.
+            with db_access.shared():
+                log.info("Getting listings for export. " + str(start))
+                conn = db.get()
+                try:
+                    db_execute(conn, "BEGIN")
+                    if full:
+                        cursors = [db_execute(conn, listingsStmt)]
+                    else:
+                        cursors = (db_execute(conn, listingsColumns + in_clause(chunk) + " ORDER BY station_id, item_id", chunk)
+                                   for chunk in station_chunks(stations))
+                        # Stations left with no live listings at all have to be
+                        # listed in the manifest, since they won't be in the delta.
+                        cleared = set(stations)
+                        for chunk in station_chunks(stations):
+                            cleared.difference_update(row[0] for row in db_execute(conn,
+                                "SELECT DISTINCT station_id FROM StationItem WHERE from_live = 1" + in_clause(chunk), chunk))
+                    log.info("Exporting '" + export_file.name + "'.")
+                    out = ExportWriter(export_file, generated)
+                    rows = write_listings(out, cursors)
+                except (sqlite3.DatabaseError, OSError) as e:
+                    log.error("Unable to export '" + export_file.name + "': " + str(e))
+                    if out:
+                        out.abort()
+                    # Make sure the stations get exported next time.
+                    with changes_lock:
+                        changed_stations |= stations
+                        full_export_due = full_export_due or full
+                    continue
+                finally:
+                    # Ends the read transaction, releasing the snapshot.
+                    conn.commit()
+
+            # If we aborted the export because we lost go, the files are broken and useless, so delete them. 
+            if rows is None:
+                out.abort()
+                log.info("Export aborted, received shutdown signal.")
                 break
             
-            while listings_file.exists():
-                try:
-                    listings_file.unlink()
-                except:
-                    time.sleep(1)
-            listings_tmp.rename(listings_file)
-            print("Export completed in " + str(datetime.datetime.now() - start))
+            # The compressed copies are moved into place along with the export,
+            # and the manifest is only updated once they all have been.
+            artifacts = out.commit()
+            entry = OrderedDict([
+                ('file', export_file.name),
+                ('sequence', sequence),
+                ('generated', generated),
+                ('rows', rows),
+                ('size', artifacts['csv']['size']),
+                ('sha256', artifacts['csv']['sha256']),
+                ('compressed', OrderedDict((format, info) for format, info in artifacts.items() if format != 'csv')),
+            ])
+            old_deltas = []
+            if full:
+                old_deltas = manifest['deltas']
+                manifest['full'] = entry
+                manifest['deltas'] = []
+                last_full = time.time()
+            else:
+                entry['base'] = manifest['full']['sequence']
+                entry['stations'] = len(stations)
+                entry['cleared_stations'] = sorted(cleared)
+                manifest['deltas'].append(entry)
+            manifest['sequence'] = sequence
+            save_manifest(manifest_file, manifest)
+
+            # The deltas from before a full export don't apply to it.
+            for delta in old_deltas:
+                for name in [delta['file']] + [info['file'] for info in delta.get('compressed', {}).values()]:
+                    try:
+                        (export_dir / Path(name)).unlink()
+                    except OSError:
+                        pass
+
+            duration = (datetime.datetime.now() - start).total_seconds()
+            metrics.observe('export', duration)
+            metrics.inc('exports_total', type = 'full' if full else 'delta')
+            log.info(("Full export" if full else "Delta export " + str(sequence)) + " completed in " + str(datetime.datetime.now() - start)\
+                     + ", " + str(rows) + " rows, " + str(int(rows / max(duration, 0.001))) + " rows per second."\
+                     + (" Peak RSS: " + str(peak_rss_mb()) + " MB." if resource else ""))
+
+        log.info("Shutting down listings exporter.")
+
+
+class IdResolver(object):
+    """
+    The lookup tables used to turn the names in market messages into TD's ids.
+
+    A resolver is never changed once it has been built. When the tables need
+    updating, a new resolver is built alongside the current one and then
+    replaces it with a single assignment, so the other threads always see a
+    consistent set of tables, and never have to wait while they're rebuilt.
+
+    Attributes:
+        version             Goes up by one with each new resolver,
+        db_name             commodity['name'].lower() => fdev_id,
+        item_ids            fdev_id => item_id,
+        system_ids          "SYSTEM" => system_id,
+        station_ids         "SYSTEM/STATION" (or "MEGASHIP/STATION") => station_id,
+        system_names        system_id => "SYSTEM",
+        station_keys        station_id => its key in station_ids,
+        modified            The latest System and Station 'modified' included,
+                            as (system modified, station modified).
+    """
+
+    tableNames = ('db_name', 'item_ids', 'system_ids', 'station_ids', 'system_names', 'station_keys')
+
+    def __init__(self, version, tables, modified):
+        self.version = version
+        # Kept so the tables can be cached and copied for the next resolver.
+        self.tables = tables
+        for name in self.tableNames:
+            setattr(self, name, MappingProxyType(tables[name]))
+        self.modified = modified
+
+
+    def __getstate__(self):
+        # The MappingProxyTypes can't be pickled, and are rebuilt anyway.
+        return (self.version, self.tables, self.modified)
+
+
+    def __setstate__(self, state):
+        self.__init__(*state)
 
-        print("Shutting down listings exporter.")
 
+    def updated(self, conn, db_name, item_ids):
+        """
+        Returns a new resolver with the given commodity and item tables, and
+        the systems and stations that have been added or changed in the
+        database since this one was built. Returns None if that's not enough
+        to bring the tables up to date, because something was renamed or
+        removed, in which case they have to be rebuilt from scratch.
+        """
+        system_ids = dict(self.tables['system_ids'])
+        system_names = dict(self.tables['system_names'])
+        station_ids = dict(self.tables['station_ids'])
+        station_keys = dict(self.tables['station_keys'])
+        system_modified, station_modified = self.modified
+
+        for system_id, name, modified in conn.execute(
+                "SELECT system_id, name, modified FROM System WHERE modified > ?", (system_modified,)):
+            name = name.upper()
+            if system_names.get(system_id, name) != name:
+                return None
+            system_names[system_id] = name
+            system_ids[name] = system_id
+            system_modified = max(system_modified, modified)
+
+        for station_id, name, system_id, type_id, modified in conn.execute(
+                "SELECT station_id, name, system_id, type_id, modified FROM Station WHERE modified > ?", (station_modified,)):
+            if system_id not in system_names:
+                return None
+            key = station_key(station_id, name, system_id, type_id, system_names)
+            old_key = station_keys.get(station_id)
+            if old_key and old_key != key:
+                del station_ids[old_key]
+            station_ids[key] = station_id
+            station_keys[station_id] = key
+            station_modified = max(station_modified, modified)
+
+        # Anything removed from the database won't have shown up above, and
+        # can't be spotted by counting, since as many may have been added.
+        if set(row[0] for row in conn.execute("SELECT system_id FROM System")) != system_names.keys()\
+                or set(row[0] for row in conn.execute("SELECT station_id FROM Station")) != station_keys.keys():
+            return None
+
+        return IdResolver(self.version + 1, {
+            'db_name': db_name,
+            'item_ids': item_ids,
+            'system_ids': system_ids,
+            'station_ids': station_ids,
+            'system_names': system_names,
+            'station_keys': station_keys,
+        }, (system_modified, station_modified))
+
+def station_key(station_id, name, system_id, type_id, system_names):
+    """
+    Returns the key station_id has in station_ids.
+    """
+    # Mobile stations can move between systems. The mobile stations 
+    # have the following data in their entry in stations.jsonl:
+    # "type_id":19,"type":"Megaship"
+    # Except for that one Orbis station.
+    if int(type_id) == 19 or int(station_id) == 42041:
+        full_name = "MEGASHIP"
     else:
-        export_ack = True
+        full_name = system_names[int(system_id)]
+    return full_name + "/" + name.upper()
 
-def update_dicts():
+def read_commodity_names():
+    """
+    Downloads EDMC's commodity list, and returns a dict of
+    commodity['name'].lower() => fdev_id.
+    """
     # We'll use this to get the fdev_id from the 'symbol', AKA commodity['name'].lower()
     db_name = dict()
     edmc_source = 'https://raw.githubusercontent.com/Marginal/EDMarketConnector/master/commodity.csv'
-    edmc_csv = request.urlopen(edmc_source)
+    edmc_csv = request.urlopen(edmc_source, timeout=30)
     edmc_dict = csv.DictReader(codecs.iterdecode(edmc_csv, 'utf-8'))
     for line in iter(edmc_dict):
         db_name[line['symbol'].lower()] = line['id']
-    
+    edmc_csv.close()
+    return db_name
+
+def read_item_ids():
+    """
+    Reads TD's Item.csv, and returns a dict of fdev_id => item_id.
+    """
     # We'll use this to get the item_id from the fdev_id because it's faster than a database lookup.
     item_ids = dict()
     with open(str(dataPath / Path("Item.csv")), "r") as fh:
@@ -856,7 +3856,13 @@ def update_dicts():
         next(iter(items))
         for item in items:
             item_ids[item[iid_key]] =  int(item['unq:item_id'])
-    
+    return item_ids
+
+def read_place_ids():
+    """
+    Reads TD's System.csv and Station.csv, and returns
+    the dicts system_ids, station_ids, system_names and station_keys.
+    """
     # We're using these for the same reason. 
     system_names = dict()
     system_ids = dict()
@@ -866,92 +3872,285 @@ def update_dicts():
             system_names[int(system['unq:system_id'])] = system['name'].upper()
             system_ids[system['name'].upper()] = int(system['unq:system_id'])
     station_ids = dict()
+    station_keys = dict()
     with open(str(dataPath / Path("Station.csv")), "r") as fh:
         stations = csv.DictReader(fh, quotechar="'")
         for station in stations:
-            # Mobile stations can move between systems. The mobile stations 
-            # have the following data in their entry in stations.jsonl:
-            # "type_id":19,"type":"Megaship"
-            # Except for that one Orbis station.
-            if int(station['type_id']) == 19 or int(station['unq:station_id']) == 42041:
-                full_name = "MEGASHIP"
-            else:
-                full_name = system_names[int(station['system_id@System.system_id'])]
-            full_name += "/" + station['name'].upper()
-            station_ids[full_name] = int(station['unq:station_id'])
-    
-    del system_names
-    
-    return db_name, item_ids, system_ids, station_ids
-
-go = True
-q = deque()
-config = load_config()
-validate_config()
-
-listener_thread = threading.Thread(target=get_messages)
-update_thread = threading.Thread(target=check_update)
-process_thread = threading.Thread(target=process_messages)
-export_thread = threading.Thread(target=export_listings)
-
-# The sooner the listener thread is started, the sooner
-# the messages start pouring in.
-print("Starting listener.")
-listener_thread.start()
-
-# First, check to make sure that EDDBlink plugin has made the changes
-# that need to be made for this thing to work correctly.
-tdb = tradedb.TradeDB(load=False)
-with tdb.sqlPath.open('r', encoding = "utf-8") as fh:
-    tmpFile = fh.read()
-
-firstRun = (tmpFile.find('system_id INTEGER PRIMARY KEY AUTOINCREMENT') != -1)
-
-if firstRun:
-    # EDDBlink plugin has not made the changes, time to fix that.
-    print("EDDBlink plugin has not been run at least once, running now.")
-    print("command: 'python trade.py import -P eddblink -O clean,skipvend'")
-    trade.main(('trade.py','import','-P','eddblink','-O','clean,skipvend'))
-    print("Finished running EDDBlink plugin, no need to run again.")
-
-else:
-    print("Running EDDBlink to perform any needed infrastructure updates.")
-    options = 'solo'
-    if config['side'] == 'server':
-        options += ',fallback'
-    trade.main(('trade.py','import','-P','eddblink','-O',options))
-    # Check to see if plugin updated database.
+            station_id = int(station['unq:station_id'])
+            full_name = station_key(station_id, station['name'], station['system_id@System.system_id'],
+                                    station['type_id'], system_names)
+            station_ids[full_name] = station_id
+            station_keys[station_id] = full_name
+    
+    return system_ids, station_ids, system_names, station_keys
+
+# Bump this whenever what's stored in the cache changes.
+DICTS_CACHE_VERSION = 2
+
+def load_dicts_cache():
+    """
+    Returns the contents of the lookup tables' cache file, or None if
+    there isn't a usable one.
+    """
+    try:
+        with dictsCachePath.open('rb') as fh:
+            cache = pickle.load(fh)
+        if cache.get('version') == DICTS_CACHE_VERSION:
+            return cache
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.info("Unable to read lookup tables cache: " + str(e))
+    return None
+
+def save_dicts_cache(stats, resolver):
+    cache_tmp = dictsCachePath.with_name(dictsCachePath.name + ".tmp")
+    try:
+        with cache_tmp.open('wb') as fh:
+            pickle.dump({
+                'version': DICTS_CACHE_VERSION,
+                'sources': stats,
+                'modified': resolver.modified,
+                'tables': resolver.tables,
+            }, fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(str(cache_tmp), str(dictsCachePath))
+    except OSError as e:
+        log.info("Unable to write lookup tables cache: " + str(e))
+
+def source_stats():
+    """
+    Returns the (modification time, size) of each of the csv files
+    the lookup tables are built from.
+    """
+    stats = {}
+    for name in ("Item.csv", "System.csv", "Station.csv"):
+        stat = (dataPath / Path(name)).stat()
+        stats[name] = (stat.st_mtime_ns, stat.st_size)
+    return stats
+
+def update_dicts(previous=None):
+    """
+    Returns an IdResolver with up-to-date lookup tables.
+
+    At startup (when there's no previous resolver,) the tables are loaded
+    from a cache file, as long as TD's csv files haven't changed since it
+    was made. The cache also keeps the last commodity list downloaded from
+    EDMC, in case it can't be downloaded.
+
+    After an EDDB update, only the systems and stations that have changed
+    since the previous resolver was built are applied to a copy of its
+    tables, if possible, rather than rebuilding them from the csv files.
+    """
+    start = time.time()
+    stats = source_stats()
+    cache = None
+    if not previous:
+        cache = load_dicts_cache()
+        if cache and cache['sources'] == stats:
+            resolver = IdResolver(1, cache['tables'], cache['modified'])
+            log.info("Loaded lookup tables from cache in " + str(int((time.time() - start) * 1000) / 1000) + " seconds.")
+            return resolver
+
+    try:
+        db_name = read_commodity_names()
+    except (OSError, ValueError) as e:
+        if previous:
+            db_name = previous.tables['db_name']
+        elif cache:
+            db_name = cache['tables']['db_name']
+        else:
+            raise
+        log.info("Unable to download commodity list, using previous copy: " + str(e))
+    item_ids = read_item_ids()
+
+    conn = connect_db()
+    try:
+        resolver = None
+        if previous:
+            resolver = previous.updated(conn, db_name, item_ids)
+            how = "updated"
+        if not resolver:
+            # The csv files are written from the database, so this is
+            # as far as they go.
+            modified = (conn.execute("SELECT IFNULL(MAX(modified), '') FROM System").fetchone()[0],
+                        conn.execute("SELECT IFNULL(MAX(modified), '') FROM Station").fetchone()[0])
+            system_ids, station_ids, system_names, station_keys = read_place_ids()
+            resolver = IdResolver(previous.version + 1 if previous else 1, {
+                'db_name': db_name,
+                'item_ids': item_ids,
+                'system_ids': system_ids,
+                'station_ids': station_ids,
+                'system_names': system_names,
+                'station_keys': station_keys,
+            }, modified)
+            how = "rebuilt"
+    finally:
+        conn.close()
+
+    save_dicts_cache(stats, resolver)
+    log.info("Lookup tables " + how + " in " + str(int((time.time() - start) * 1000) / 1000) + " seconds"\
+             + ("" if previous else (", cache " + ("out of date" if cache else "not found"))) + ".")
+    
+    return resolver
+
+# Everything from here on only runs in the listener itself, not in the worker
+# processes of a process resolve pool, which import this as a module.
+if __name__ == "__main__":
+    go = True
+    config = load_config()
+    validate_config()
+    # Log records are queued for the log writer thread to write, so nothing
+    # has to wait on the console or the log file.
+    log_queue = queue.Queue(config['log_queue_size'])
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(ConsoleFormatter())
+    console.setLevel(logging.INFO)
+    log_writers = [LogWriter(log_queue, setup_log_handler(log_queue), console)]
+    # The workers of a process resolve pool can't use this process's queue,
+    # so they get one of their own.
+    worker_log_queue = None
+    if config['resolve_pool'] == 'process':
+        worker_log_queue = multiprocessing.get_context('spawn').Queue(config['log_queue_size'])
+        log_writers.append(LogWriter(worker_log_queue, None, console))
+    for writer in log_writers:
+        writer.start()
+    atexit.register(stop_logging, log_writers)
+    message_filter = MessageFilter(config['whitelist'])
+    q = WorkQueue(config['queue_high_water'], config['queue_overflow_policy'], Path("eddblink-listener-spill"))
+    # Used to wake up the threads when they're sleeping and the shutdown signal is sent.
+    signals = threading.Condition()
+    db_access = DBAccess()
+    # The stations updated since the last listings export, and whether the next
+    # export has to be a full one. We don't know what was updated while we
+    # weren't running, so the first export always is.
+    changes_lock = threading.Lock()
+    changed_stations = set()
+    full_export_due = True
+    # The messages written while a shadow import is running, or None if there isn't one.
+    journal_lock = threading.Lock()
+    shadow_journal = None
+    # When each station's market was last written, for rejecting stale messages.
+    freshness = StationFreshness(config['freshness_cache_size'])
+    # What each station's market was last written with, for spotting re-sends.
+    snapshots = SnapshotCache(config['snapshot_cache_size'])
+    # The average prices waiting to be written.
+    avg_prices = AvgPriceCache(config['avg_price_flush_every_x_sec'])
+    # The stations and items the lookup tables don't know, and the parked
+    # messages for those stations.
+    unknowns = UnknownCache(config['unknown_ttl_sec'], config['unknown_max_parked'])
+    # The resolved batches waiting to be written, and how busy each stage is.
+    resolved_q = queue.Queue(2)
+    resolve_timer = StageTimer()
+    worker_timer = StageTimer(config['resolve_workers'])
+    write_timer = StageTimer()
+    # What the metrics endpoint and summary show, besides the stage timings.
+    metrics.register('queue_depth', 'gauge', "Messages waiting in the queue.", lambda: len(q))
+    metrics.register('queue_coalesced_total', 'counter', "Messages merged with a newer message for the same station.", lambda: q.coalesced)
+    metrics.register('queue_dropped_total', 'counter', "Messages dropped because the queue was full.", lambda: q.dropped)
+    metrics.register('queue_spilled_total', 'counter', "Messages spilled to disk because the queue was full.", lambda: q.spilled)
+    metrics.register('resolved_depth', 'gauge', "Resolved batches waiting to be written.", resolved_q.qsize)
+    metrics.register('parked', 'gauge', "Messages parked for unknown stations.", lambda: len(unknowns.parked))
+    metrics.register('avg_prices_pending', 'gauge', "Average prices waiting to be written.", lambda: len(avg_prices.pending))
+    metrics_server = None
+    if config['metrics_port']:
+        metrics_server = start_metrics_server(config['metrics_port'])
+
+    listener_thread = threading.Thread(target=get_messages, name="Listener")
+    update_thread = threading.Thread(target=check_update, name="Update checker")
+    resolve_thread = threading.Thread(target=resolve_batches, name="Message resolver")
+    process_thread = threading.Thread(target=process_messages, name="Message processor")
+    export_thread = threading.Thread(target=export_listings, name="Listings exporter")
+
+    # The sooner the listener thread is started, the sooner
+    # the messages start pouring in.
+    log.info("Starting listener.")
+    listener_thread.start()
+
+    # First, check to make sure that EDDBlink plugin has made the changes
+    # that need to be made for this thing to work correctly.
+    tdb = tradedb.TradeDB(load=False)
     with tdb.sqlPath.open('r', encoding = "utf-8") as fh:
         tmpFile = fh.read()
-    if tmpFile.find("type_id INTEGER DEFAULT 0 NOT NULL,") == -1:
-        sys.exit("EDDBlink plugin must be updated for listener to work correctly.")
 
-update_busy = False
-process_ack = False
-export_ack = False
-export_busy = False
+    firstRun = (tmpFile.find('system_id INTEGER PRIMARY KEY AUTOINCREMENT') != -1)
 
-dataPath = Path(tradeenv.TradeEnv().dataDir).resolve()
-eddbPath = plugins.eddblink_plug.ImportPlugin(tdb, tradeenv.TradeEnv()).dataPath.resolve()
-debugPath = eddbPath / Path("debug.txt")
+    if firstRun:
+        # EDDBlink plugin has not made the changes, time to fix that.
+        log.info("EDDBlink plugin has not been run at least once, running now.")
+        log.info("command: 'python trade.py import -P eddblink -O clean,skipvend'")
+        trade.main(('trade.py','import','-P','eddblink','-O','clean,skipvend'))
+        log.info("Finished running EDDBlink plugin, no need to run again.")
 
-db_name, item_ids, system_ids, station_ids = update_dicts()
+    else:
+        log.info("Running EDDBlink to perform any needed infrastructure updates.")
+        options = 'solo'
+        if config['side'] == 'server':
+            options += ',fallback'
+        trade.main(('trade.py','import','-P','eddblink','-O',options))
+        # Check to see if plugin updated database.
+        with tdb.sqlPath.open('r', encoding = "utf-8") as fh:
+            tmpFile = fh.read()
+        if tmpFile.find("type_id INTEGER DEFAULT 0 NOT NULL,") == -1:
+            sys.exit("EDDBlink plugin must be updated for listener to work correctly.")
 
-print("Press CTRL-C at any time to quit gracefully.")
-try:
-    update_thread.start()
-    # Give the update checker enough time to see if an update is needed,
-    # before starting the message processor and listings exporter.
-    time.sleep(5)
-    process_thread.start()
-    export_thread.start()
+    dbPath = Path(tdb.dbPath).resolve()
 
-    while True:
-        time.sleep(1)
-except KeyboardInterrupt:
-    print("CTRL-C detected, stopping.")
-    if config['side'] == 'server':
-        print("Please wait for all four processes to report they are finished, in case they are currently active.")
-    else:
-        print("Please wait for all three processes to report they are finished, in case they are currently active.")
-    go = False
\ No newline at end of file
+    # WAL mode lets the listings exporter read from a snapshot of the
+    # database while the message processor is writing to it. A shadow import
+    # needs it too, since copying a database in any other mode keeps anything
+    # from being committed to it until the copy is finished.
+    use_wal = config['side'] == 'server' or config['import_mode'] == 'shadow'
+    if use_wal:
+        # The setting is stored in the database file, so only needs doing once.
+        conn = connect_db()
+        journal_mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        conn.close()
+        if journal_mode.lower() != 'wal':
+            log.warning("Unable to put the database into WAL mode, journal mode is '" + journal_mode + "'.")
+
+    dataPath = Path(tradeenv.TradeEnv().dataDir).resolve()
+    eddbPath = plugins.eddblink_plug.ImportPlugin(tdb, tradeenv.TradeEnv()).dataPath.resolve()
+    debugPath = eddbPath / Path("debug.txt")
+    if config['debug']:
+        log_file = BufferedLogFile(debugPath, config['log_file_max_mb'] * 1024 * 1024, config['log_file_backups'])
+        log_file.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(threadName)s: %(message)s"))
+        for writer in log_writers:
+            writer.add_handler(log_file)
+    dictsCachePath = dataPath / Path("eddblink-listener-dicts.pickle")
+
+    resolver = update_dicts()
+
+    log.info("Press CTRL-C at any time to quit gracefully.")
+    try:
+        update_thread.start()
+        # Give the update checker enough time to see if an update is needed,
+        # before starting the message processor and listings exporter.
+        time.sleep(5)
+        resolve_thread.start()
+        process_thread.start()
+        export_thread.start()
+
+        summary_time = time.time()
+        while True:
+            time.sleep(1)
+            if config['metrics_summary_every_x_sec'] and time.time() >= summary_time + config['metrics_summary_every_x_sec']:
+                summary_time = time.time()
+                log.info(metrics.summary())
+    except KeyboardInterrupt:
+        log.info("CTRL-C detected, stopping.")
+        if config['side'] == 'server':
+            log.info("Please wait for all five processes to report they are finished, in case they are currently active.")
+        else:
+            log.info("Please wait for all four processes to report they are finished, in case they are currently active.")
+        with signals:
+            go = False
+            signals.notify_all()
+        q.wake()
+        if metrics_server:
+            metrics_server.shutdown()
+        # Once the message processor has written the batches the resolver has
+        # already taken, anything left in the queue is saved to disk, if
+        # spilling is enabled.
+        if process_thread.is_alive():
+            process_thread.join()
+        q.close()
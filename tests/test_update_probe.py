@@ -0,0 +1,136 @@
+"""
+Tests for UpdateProbe against a local stand-in for the EDDB mirror.
+
+Importing the listener needs TD and zmq, so run these from TD's folder,
+like the listener itself:
+
+    python -m unittest discover -s <path to>/tests
+"""
+
+import http.server
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import eddblink_listener
+except ImportError as e:
+    eddblink_listener = None
+    skipReason = "eddblink_listener can't be imported: " + str(e)
+else:
+    skipReason = ""
+
+MODIFIED = "Wed, 14 Oct 2026 12:00:00 GMT"
+MODIFIED_EPOCH = 1791979200
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves "/listings.csv" as last modified at MODIFIED, answering
+    conditional requests with a 304, "/nohead.csv" the same but without
+    HEAD, and "/moved.csv" as a redirect to "/listings.csv". Every request
+    is recorded in the server's requests, as (method, path, headers).
+    """
+    protocol_version = "HTTP/1.1"
+
+
+    def do_HEAD(self):
+        self.respond(head = True)
+
+
+    def do_GET(self):
+        self.respond(head = False)
+
+
+    def respond(self, head):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        if self.path == "/moved.csv":
+            self.send_response(301)
+            self.send_header("Location", "/listings.csv")
+            self.send_header("Content-Length", "0")
+        elif self.path == "/nohead.csv" and head:
+            self.send_response(405)
+            self.send_header("Content-Length", "0")
+        elif self.path in ("/listings.csv", "/nohead.csv"):
+            if self.headers.get("If-Modified-Since") == MODIFIED:
+                self.send_response(304)
+            else:
+                self.send_response(200)
+                self.send_header("Last-Modified", MODIFIED)
+                self.send_header("Content-Length", "0")
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+        self.end_headers()
+        if self.server.hangUp:
+            # Close the connection without telling the client, as a server
+            # timing out an idle kept-alive connection would.
+            self.close_connection = True
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+@unittest.skipIf(eddblink_listener is None, skipReason)
+class UpdateProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.hangUp = False
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        self.base = "http://127.0.0.1:" + str(self.server.server_address[1])
+        self.probe = eddblink_listener.UpdateProbe(timeout = 5)
+
+
+    def tearDown(self):
+        for scheme, host in list(self.probe.connections):
+            self.probe.disconnect(scheme, host)
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def test_head_then_conditional(self):
+        self.assertEqual(self.probe.last_modified(self.base + "/listings.csv"), MODIFIED_EPOCH)
+        method, path, headers = self.server.requests[0]
+        self.assertEqual(method, "HEAD")
+        self.assertNotIn("If-Modified-Since", headers)
+
+        # The second probe is conditional, and the 304 gives the known time.
+        self.assertEqual(self.probe.last_modified(self.base + "/listings.csv"), MODIFIED_EPOCH)
+        method, path, headers = self.server.requests[1]
+        self.assertEqual(method, "HEAD")
+        self.assertEqual(headers.get("If-Modified-Since"), MODIFIED)
+
+
+    def test_get_when_head_not_allowed(self):
+        self.assertEqual(self.probe.last_modified(self.base + "/nohead.csv"), MODIFIED_EPOCH)
+        self.assertEqual([request[0] for request in self.server.requests], ["HEAD", "GET"])
+
+
+    def test_broken_connection_retried(self):
+        self.server.hangUp = True
+        self.assertEqual(self.probe.last_modified(self.base + "/listings.csv"), MODIFIED_EPOCH)
+        conn = next(iter(self.probe.connections.values()))
+        # The server has closed the connection the probe is keeping alive.
+        self.assertEqual(self.probe.last_modified(self.base + "/listings.csv"), MODIFIED_EPOCH)
+        self.assertIsNot(next(iter(self.probe.connections.values())), conn)
+        self.assertEqual(len(self.server.requests), 2)
+
+
+    def test_redirect_followed(self):
+        self.assertEqual(self.probe.last_modified(self.base + "/moved.csv"), MODIFIED_EPOCH)
+        self.assertEqual([request[1] for request in self.server.requests], ["/moved.csv", "/listings.csv"])
+        # What's known is kept for where the redirect leads.
+        self.assertIn(self.base + "/listings.csv", self.probe.known)
+        self.assertEqual(self.probe.last_modified(self.base + "/moved.csv"), MODIFIED_EPOCH)
+        self.assertEqual(self.server.requests[3][2].get("If-Modified-Since"), MODIFIED)
+
+
+if __name__ == "__main__":
+    unittest.main()